@@ -5,4 +5,5 @@ from .util import *
 from .karnaugh import *
 from .qmc import *
 from .lut import *
-from .rulesets import *
\ No newline at end of file
+from .rulesets import *
+from .bdd import *
\ No newline at end of file
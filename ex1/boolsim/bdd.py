@@ -0,0 +1,113 @@
+import weakref
+
+# Reduced ordered binary decision diagrams, a canonical form of functions.
+# Nodes are shared, so two functions are equal iff their diagrams are
+# the same object. Variables are ordered by their names.
+# Operations take the same operator functions as truth tables do
+# (truth_table_op of the operators), applied to 0/1 terminal values.
+class BddNode:
+    # low is followed when var is False, high when it's True.
+    # Terminals have no var, only a value.
+    __slots__ = ('_var', '_low', '_high', '_value', '_initialized', '__weakref__')
+
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, var, low, high, value=None):
+        key = (var, id(low), id(high), value)
+        instance = BddNode._instances.get(key)
+        if instance is None:
+            instance = super().__new__(cls)
+            instance._initialized = False
+            BddNode._instances[key] = instance
+        return instance
+
+    def __init__(self, var, low, high, value=None):
+        if self._initialized:
+            return
+        self._initialized = True
+
+        self._var = var
+        self._low = low
+        self._high = high
+        self._value = value
+
+    @property
+    def var(self):
+        return self._var
+
+    @property
+    def low(self):
+        return self._low
+
+    @property
+    def high(self):
+        return self._high
+
+    @property
+    def value(self):
+        return self._value
+
+    def is_terminal(self):
+        return self._var is None
+
+    def __repr__(self):
+        if self._var is None:
+            return 'BddNode: {0}'.format(self._value)
+        return 'BddNode: {0} ? {1} : {2}'.format(self._var, repr(self._high), repr(self._low))
+
+BDD_FALSE = BddNode(None, None, None, 0)
+BDD_TRUE = BddNode(None, None, None, 1)
+
+def bdd_constant(value):
+    return BDD_TRUE if value else BDD_FALSE
+
+def bdd_node(var, low, high):
+    # reduced, a node with both successors the same is not needed
+    if low is high:
+        return low
+    return BddNode(var, low, high)
+
+def bdd_variable(name):
+    return BddNode(name, BDD_FALSE, BDD_TRUE)
+
+# only the lowest bit of the result of op is used
+def bdd_apply_unary(op, node):
+    memo = {}
+
+    def apply(u):
+        if u._var is None:
+            return bdd_constant(op(u._value) & 1)
+        result = memo.get(id(u))
+        if result is None:
+            result = bdd_node(u._var, apply(u._low), apply(u._high))
+            memo[id(u)] = result
+        return result
+
+    return apply(node)
+
+def bdd_apply(op, lhs, rhs):
+    # Both operands are alive for the whole call, so the ids are stable.
+    memo = {}
+
+    def apply(u, v):
+        u_var = u._var
+        v_var = v._var
+        if u_var is None and v_var is None:
+            return bdd_constant(op(u._value, v._value) & 1)
+
+        key = (id(u), id(v))
+        result = memo.get(key)
+        if result is not None:
+            return result
+
+        if v_var is None or (u_var is not None and u_var < v_var):
+            result = bdd_node(u_var, apply(u._low, v), apply(u._high, v))
+        elif u_var is None or v_var < u_var:
+            result = bdd_node(v_var, apply(u, v._low), apply(u, v._high))
+        else:
+            result = bdd_node(u_var, apply(u._low, v._low), apply(u._high, v._high))
+
+        memo[key] = result
+        return result
+
+    return apply(lhs, rhs)
@@ -14,28 +14,42 @@ equality/truthness checks between expressions.
 """
 
 from .util import *
-
-import textwrap
+from .bdd import *
+
+import collections
+import functools
+import random
+import weakref
+import zlib
+
+# Hashes of str differ between runs (unless PYTHONHASHSEED is set), so
+# names of symbols and types are hashed with crc32 instead. Tuples of ints
+# hash the same in every run, so hashes of whole expressions, and
+# the order of operands following them, are the same in every run too.
+@functools.lru_cache(maxsize=4096)
+def _name_hash(name):
+    return zlib.crc32(name.encode())
 
 def gather_symbols_from_expr(expr):
     """Gather names of unique symbols in the expression.
 
-    Searches the expression recusively and remembers names of all
-    unique symbols encountered.
+    The set of symbols is computed once when the expression is created,
+    so no search is made.
 
     Args:
         expr (Expression): The expression to gather symbols from.
 
     Returns:
-        list of str: A list of names.
+        list of str: A list of names, sorted so that their order
+            is the same in every run.
     """
-    return list({e.name for e in expr if type(e) == Symbol})
+    return sorted(expr.symbols)
 
 def count_distinct_symbols(expr):
     """Count how many distinct symbols are in the expression.
 
     Effectively returns the length of a list returned by
-    gather_symbols_from_expr.
+    gather_symbols_from_expr, but doesn't form the list.
 
     Args:
         expr (Expression): The expression to count symbols in.
@@ -43,15 +57,18 @@ def count_distinct_symbols(expr):
     Returns:
         int: Number of distinctly named symbols.
     """
-    return len(gather_symbols_from_expr(expr))
+    return len(expr.symbols)
 
 def evaluates_to(expr, boolean):
     """Check if the given expression evaluates to a given boolean.
 
     Checks whether the given expression is equal to a given boolean for
     all possible inputs (all possible combinations of symbols used by the
-    expression). It short-circuits, so it reports failure as soon as
-    possible.
+    expression). All inputs are checked at once by comparing the truth table
+    of the expression against the one of a constant.
+    The semantic fingerprint of the expression is checked first, it is
+    already evaluated for a batch of inputs and usually rules out
+    expressions that are not constant.
 
     Args:
         expr (Expression): The expression to evaluate.
@@ -60,13 +77,116 @@ def evaluates_to(expr, boolean):
     Returns:
         bool: True on success, False on failure
     """
+    if expr.semantic_fingerprint != (mask(FINGERPRINT_BITS) if boolean else 0):
+        return False
+
     ids_to_symbols = gather_symbols_from_expr(expr)
-    dim = len(ids_to_symbols)
-    for i in range(pow2(dim)):
-        if expr.evaluate(symbol_dict_from_index(ids_to_symbols, BoolVector(dim, i))) != boolean:
-            return False
+    tt = evaluate_truth_table(expr, ids_to_symbols)
+    return tt == (mask(pow2(len(ids_to_symbols))) if boolean else 0)
 
-    return True
+def truth_table_masks(ids_to_symbols):
+    """Compute truth table columns for given variables.
+
+    For each variable forms a bitfield where the i-th bit is the value
+    the variable takes in the i-th input (see symbol_dict_from_index).
+
+    Args:
+        ids_to_symbols (list of str): Subsequent variable names.
+
+    Returns:
+        dict of (str, int): Truth table column for every variable.
+    """
+    num_vars = len(ids_to_symbols)
+    return {name : _truth_table_column(k, num_vars) for k, name in enumerate(ids_to_symbols)}
+
+# Columns depend only on the position of the variable, so they are
+# shared by all expressions with the same number of variables.
+@functools.lru_cache(maxsize=1024)
+def _truth_table_column(k, num_vars):
+    # 2^k zeroes followed by 2^k ones, repeated to fill all rows
+    num_rows = pow2(num_vars)
+    period = pow2(k + 1)
+    column = mask(pow2(k)) << pow2(k)
+    while period < num_rows:
+        column |= column << period
+        period <<= 1
+    return column
+
+def evaluate_truth_table(expr, ids_to_symbols):
+    """Evaluate given expression for all possible inputs at once.
+
+    Computes the whole truth table of the expression with bitwise operations
+    on integers, one per node, instead of evaluating the expression
+    once per input. The operations are run from a flat program of
+    the expression (see get_truth_table_program).
+
+    Args:
+        expr (Expression): Expression to evaluate.
+        ids_to_symbols (list of str): Order of input variables by name.
+
+    Returns:
+        int: Bitfield with the i-th bit set iff the expression evaluates
+            to True for the i-th input (in order as in evaluate_all).
+    """
+    return evaluate_truth_tables([expr], ids_to_symbols)[0]
+
+def evaluate_truth_tables(exprs, ids_to_symbols):
+    """Evaluate many expressions for all possible inputs at once.
+
+    Same as evaluate_truth_table for each expression, but the truth table
+    columns are formed only once. Each expression is evaluated by running
+    its truth table program (see get_truth_table_program).
+
+    Args:
+        exprs (list of Expression): Expressions to evaluate.
+        ids_to_symbols (list of str): Order of input variables by name.
+
+    Returns:
+        list of int: Truth tables of respective expressions.
+    """
+    var_masks = truth_table_masks(ids_to_symbols)
+    rows_mask = mask(pow2(len(ids_to_symbols)))
+    return [_run_truth_table_program(expr.get_truth_table_program(), var_masks) & rows_mask for expr in exprs]
+
+_TT_VARIABLE, _TT_CONSTANT, _TT_UNARY, _TT_BINARY = range(4)
+
+def _run_truth_table_program(program, var_masks):
+    # Postfix instructions operating on a stack of truth tables.
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    for kind, arg in program:
+        if kind == _TT_BINARY:
+            rhs = pop()
+            stack[-1] = arg(stack[-1], rhs)
+        elif kind == _TT_VARIABLE:
+            push(var_masks[arg])
+        elif kind == _TT_UNARY:
+            stack[-1] = arg(stack[-1])
+        else:
+            push(arg)
+    return stack[0]
+
+FINGERPRINT_BITS = 64
+
+# Number of symbols from which equivalence is checked with decision
+# diagrams instead of truth tables.
+BDD_MIN_SYMBOLS = 20
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint_column(name):
+    """Pseudo-random values of a variable used for semantic fingerprints.
+
+    The values depend only on the name of the variable, so they are
+    the same for every expression, regardless of other variables used.
+
+    Args:
+        name (str): Variable name.
+
+    Returns:
+        int: Bitfield with FINGERPRINT_BITS values of the variable.
+    """
+    return random.Random(name).getrandbits(FINGERPRINT_BITS)
 
 def symbol_dict_from_index(ids_to_symbols, index):
     """Convert a list of unnamed values to named values.
@@ -99,8 +219,9 @@ def evaluate_all(expr, ids_to_symbols):
         list of bool: All 2^n (where n = len(ids_to_symbols)) evaluations of the
             expression in increasing order of input (000, 001, 010, ...)
     """
-    dim = len(ids_to_symbols)
-    return [expr.evaluate(symbol_dict_from_index(ids_to_symbols, BoolVector(dim, i))) for i in range(pow2(dim))]
+    num_rows = pow2(len(ids_to_symbols))
+    tt = evaluate_truth_table(expr, ids_to_symbols)
+    return [c == '1' for c in reversed(format(tt, '0{0}b'.format(num_rows)))]
 
 def is_true_by_evaluation(expr):
     """Check if the expression is always True.
@@ -135,7 +256,11 @@ def are_equal_by_evaluation(lhs, rhs):
 
     Checks if the given expressions are equal for all possible
     inputs. Ie. lhs <=> rhs is a tautology.
-    Uses evaluation.
+    Uses evaluation, by comparing truth tables of the expressions.
+    For many symbols canonical decision diagrams are compared instead.
+    Semantic fingerprints, kept with the expressions, are compared first,
+    so full evaluation is only done for the few pairs that pass them.
+    Expressions with no common symbols are evaluated separately.
 
     Args:
         lhs (Expression): The left hand side expression.
@@ -144,15 +269,43 @@ def are_equal_by_evaluation(lhs, rhs):
     Returns:
         bool: True if the expressions are always equal, false otherwise.
     """
-    expr = Equivalency(lhs, rhs)
-    return is_true_by_evaluation(expr)
+    if lhs is rhs:
+        return True
+
+    # Differing fingerprints mean there is an input they differ for.
+    if lhs.semantic_fingerprint != rhs.semantic_fingerprint:
+        return False
+
+    # Diagrams are canonical, so if both are there already
+    # nothing has to be evaluated.
+    if lhs._bdd is not None and rhs._bdd is not None:
+        return lhs._bdd is rhs._bdd
+
+    symbols = lhs._symbols | rhs._symbols
+
+    # Truth tables grow exponentially, canonical diagrams usually don't.
+    if len(symbols) >= BDD_MIN_SYMBOLS:
+        return lhs.to_bdd() is rhs.to_bdd()
+
+    # Expressions of different variables can only be equal if both are
+    # the same constant, which is checked on their own (far smaller) tables.
+    if lhs._symbols.isdisjoint(rhs._symbols):
+        value = lhs.semantic_fingerprint != 0
+        return evaluates_to(lhs, value) and evaluates_to(rhs, value)
+
+    lhs_tt, rhs_tt = evaluate_truth_tables([lhs, rhs], list(symbols))
+    return lhs_tt == rhs_tt
 
 def are_opposite_by_evaluation(lhs, rhs):
     """Check if given expressions are never equal.
 
     Checks if the given expressions are different for all possible
     inputs. Ie. lhs <=> rhs is never True.
-    Uses evaluation.
+    Uses evaluation, by comparing truth tables of the expressions.
+    For many symbols canonical decision diagrams are compared instead.
+    Semantic fingerprints, kept with the expressions, are compared first,
+    so full evaluation is only done for the few pairs that pass them.
+    Expressions with no common symbols are evaluated separately.
 
     Args:
         lhs (Expression): The left hand side expression.
@@ -161,8 +314,45 @@ def are_opposite_by_evaluation(lhs, rhs):
     Returns:
         bool: True if the expressions are never equal, false otherwise.
     """
-    expr = Equivalency(lhs, rhs)
-    return is_false_by_evaluation(expr)
+    if lhs is rhs:
+        return False
+    if type(lhs) is Negation and lhs._arg is rhs or type(rhs) is Negation and rhs._arg is lhs:
+        return True
+
+    if lhs.semantic_fingerprint != rhs.semantic_fingerprint ^ mask(FINGERPRINT_BITS):
+        return False
+
+    symbols = lhs._symbols | rhs._symbols
+
+    if len(symbols) >= BDD_MIN_SYMBOLS or (lhs._bdd is not None and rhs._bdd is not None):
+        return lhs.to_bdd() is bdd_apply_unary(Negation.truth_table_op, rhs.to_bdd())
+
+    if lhs._symbols.isdisjoint(rhs._symbols):
+        value = lhs.semantic_fingerprint != 0
+        return evaluates_to(lhs, value) and evaluates_to(rhs, not value)
+
+    lhs_tt, rhs_tt = evaluate_truth_tables([lhs, rhs], list(symbols))
+    return lhs_tt ^ rhs_tt == mask(pow2(len(symbols)))
+
+@functools.lru_cache(maxsize=1024)
+def _symbol_occurrences(expr):
+    return tuple(e._name for e in expr if type(e) is Symbol)
+
+def substituted_complexity(expr, variables):
+    """Compute complexity of an expression after a substitution.
+
+    Gives the complexity of expr.substitute(variables) without
+    forming the expression.
+
+    Args:
+        expr (Expression): Expression to substitute into.
+        variables (dict of (str, Expression)): Expressions to substitute
+            under certain variables (symbols).
+
+    Returns:
+        int: The complexity after substitution.
+    """
+    return expr.complexity + sum(variables[name].complexity - Symbol.self_complexity for name in _symbol_occurrences(expr))
 
 def add_if_no_conflict(d, key, value):
     """Try add value to a dictionary disallowing collisions.
@@ -183,17 +373,47 @@ def add_if_no_conflict(d, key, value):
         bool: True if the value was inserted or equal to the previous one,
             False otherwise
     """
-    if key in d:
+    prev = d.get(key)
+    if prev is not None:
         # The check by truth tables is necessary, because we don't
         # permute expressions on leaves of simplifying rules.
-        # The expression tree equality check is an optimistic heuristic.
-        return d[key] == value or are_equal_by_evaluation(d[key], value)
+        # Structurally equal expressions are the same object, so
+        # the identity check is an optimistic heuristic.
+        return prev is value or are_equal_by_evaluation(prev, value)
 
     d[key] = value
     return True
 
 
 
+class PathNode(collections.namedtuple('PathNode', 'node parent depth index')):
+    """Path from the root to a node of an expression.
+
+    Paths are linked from the last node to the root, so paths to
+    children can share the path to their parent and don't have to be
+    copied when saved.
+    Each node of the path knows its position among the children of
+    its parent, so the path can be followed even if both children
+    of a node are the same expression.
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def extend(path, node, index):
+        """Form a path to a child of the last node.
+
+        Args:
+            path (PathNode): Path to the parent or None for the root.
+            node (Expression): The child.
+            index (int): Position of the child among children of the parent,
+                None for the root.
+
+        Returns:
+            PathNode: Path ending at node.
+        """
+        return PathNode(node, path, path.depth + 1 if path else 1, index)
+
 class Expression:
     """Base class for all expression types.
 
@@ -205,25 +425,92 @@ class Expression:
     Defines manipulation methods common for each expression.
     """
 
+    # Fields common for all nodes. __weakref__ is needed by the
+    # WeakValueDictionary that interns the nodes.
+    __slots__ = ('_initialized', '_complexity', '_hash', '_symbols', '_fingerprint', '_simplified', '_truth_table_program', '_str', '_bdd', '__weakref__')
+
+    # All nodes are interned, so equal expressions are the same object
+    # and equality is the default one - by identity.
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Handlers for matching against patterns of each type, see
+        # try_match_once. Symbols match any node, their handlers are
+        # added once all types are defined.
+        cls._match_handlers = {cls: cls._match_same}
+
+    def try_match_once(self, pattern, captures):
+        """Try match the node with the given pattern.
+
+        Tries to match the node with expression given in pattern.
+        Updates captures if pattern is a symbol.
+        Can modify captures even on failure.
+        Does at most one match.
+
+        Args:
+            pattern (Expression): Expression to try match against.
+            captures (dict of (str, Expression)): captures from previous
+                matches of the same pattern.
+
+        Returns:
+            bool: True if the match was successful, False otherwise.
+        """
+        handler = self._match_handlers.get(type(pattern))
+        return handler(self, pattern, captures) if handler else False
+
+    def _match_symbol(self, pattern, captures):
+        return add_if_no_conflict(captures, pattern._name, self)
+
+    def try_match_all(self, pattern, prev_captures):
+        """Try match the node with the given pattern.
+
+        Similar as try_match_ones, but is made in a form of a generator that
+        can report multiple matches per node. Matching is done by
+        a MatchProgram compiled from the pattern.
+
+        prev_captures is never modified.
+
+        Args:
+            pattern (Expression): Expression to try match against.
+            prev_captures (dict of (str, Expression)): captures from previous
+                matches of the same pattern.
+
+        Yields:
+            (bool, (dict of (str, Expression)): A boolean indicating whether
+                the match was successful and a copy of captures made during
+                the matching. A single unsuccessful result is yielded
+                if there are no matches.
+
+        """
+        matched = False
+        for pattern_captures in compile_pattern(pattern).matches(self):
+            captures = prev_captures.copy()
+            if all(add_if_no_conflict(captures, name, e) for name, e in pattern_captures.items()):
+                matched = True
+                yield (True, captures)
+        if not matched:
+            yield (False, prev_captures)
+
     def get_paths_to_some_matches(self, pattern):
         """Gather some paths to nodes that match against pattern.
 
         For each node of the expression recursively gathers paths
-        (path is a (list, dict) pair consisting of a list of nodes
-        in the expression tree forming the path to the node that matched
-        against pattern and a dictionary with captures made during the match).
+        (path is a (PathNode, dict) pair consisting of the path from the root
+        of the expression tree to the node that matched against pattern
+        and a dictionary with captures made during the match).
         Only one succesful match is allowed per expression node.
+        The pairs can be passed to apply_pattern_after_path.
 
         Args:
             pattern (Expression): Expression that serves as a pattern for matching.
                 Symbols in the pattern can capture subtrees of the expression.
 
         Returns:
-            list of (list, dict): Paths to nodes with succesful matching as well
+            list of (PathNode, dict): Paths to nodes with succesful matching as well
                 as respective captures made during matching.
         """
         all_paths = []
-        self.gather_paths_to_some_matches(pattern, all_paths, [])
+        self.gather_paths_to_some_matches(pattern, all_paths, None)
         return all_paths
 
     def get_paths_to_all_matches(self, pattern):
@@ -234,10 +521,10 @@ class Expression:
         reported.
         """
         all_paths = []
-        self.gather_paths_to_all_matches(pattern, all_paths, [])
+        self.gather_paths_to_all_matches(pattern, all_paths, None)
         return all_paths
 
-    def apply_pattern_recursively_to_some(self, to_match, to_apply):
+    def apply_pattern_recursively_to_some(self, to_match, to_apply, max_complexity=None):
         """Form new expressions with given substitutes.
 
         Finds nodes that match to_match pattern and changes them
@@ -251,32 +538,164 @@ class Expression:
         Args:
             to_match (Expression): Expression working as a pattern for matching nodes.
             to_apply (Expression): Expression to substitute previously made captures into.
+            max_complexity (int): If given, substitutions that would result in
+                a more complex expression are skipped.
 
         Returns:
             list of Expression: New expressions with appropriate substitutions made.
         """
         resulting_expressions = set()
 
-        paths = self.get_paths_to_some_matches(to_match)
-        for path in paths:
-            resulting_expressions.add(self.apply_pattern_after_path(to_match, to_apply, path))
+        # Substitutions are made as matches are found, so paths
+        # to them are not collected first.
+        for path in self.__iter_paths():
+            captures = dict()
+            if not path.node.try_match_once(to_match, captures):
+                continue
+            if self.__exceeds_complexity(to_apply, path, captures, max_complexity):
+                continue
+            resulting_expressions.add(self.apply_pattern_after_path(to_match, to_apply, (path, captures)))
 
         return resulting_expressions
 
-    def apply_pattern_recursively_to_all(self, to_match, to_apply):
+    def apply_rules_recursively_to_some(self, pattern_index, max_complexity=None):
+        """Form new expressions with substitutes from many rules.
+
+        Works the same as apply_pattern_recursively_to_some called for
+        every rule, but the expression is traversed only once and each node
+        is matched only against the rules that can match its type.
+
+        Args:
+            pattern_index (PatternIndex): Rules indexed by type of the pattern.
+            max_complexity (int): See apply_pattern_recursively_to_some.
+
+        Returns:
+            set of Expression: New expressions with appropriate substitutions made.
+        """
+        resulting_expressions = set()
+
+        for path in self.__iter_paths():
+            node = path.node
+            for to_match, to_apply in pattern_index.rules_for(node):
+                captures = dict()
+                if not node.try_match_once(to_match, captures):
+                    continue
+                if self.__exceeds_complexity(to_apply, path, captures, max_complexity):
+                    continue
+                resulting_expressions.add(self.apply_pattern_after_path(None, to_apply, (path, captures)))
+
+        return resulting_expressions
+
+    def apply_pattern_recursively_to_all(self, to_match, to_apply, max_complexity=None):
         """Form new expressions with given substitutes.
 
         This method works the same as apply_pattern_recursively_to_some,
         but it allows multiple matches per node.
         """
         resulting_expressions = set()
+        program = compile_pattern(to_match)
 
-        paths = self.get_paths_to_all_matches(to_match)
-        for path in paths:
-            resulting_expressions.add(self.apply_pattern_after_path(to_match, to_apply, path))
+        for path in self.__iter_paths():
+            for captures in program.matches(path.node):
+                if self.__exceeds_complexity(to_apply, path, captures, max_complexity):
+                    continue
+                resulting_expressions.add(self.apply_pattern_after_path(None, to_apply, (path, captures)))
 
         return resulting_expressions
 
+    def __iter_paths(self):
+        # Paths to all nodes, parents first, walked without recursion.
+        # Only the paths still to be visited are kept.
+        stack = [PathNode(self, None, 1, None)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            path = pop()
+            yield path
+            children = path.node.children()
+            if children:
+                depth = path.depth + 1
+                for i in range(len(children) - 1, -1, -1):
+                    push(PathNode(children[i], path, depth, i))
+
+    def __exceeds_complexity(self, to_apply, path, captures, max_complexity):
+        # Only the matched node changes, so the complexity is known
+        # before the expression is formed.
+        if max_complexity is None:
+            return False
+        return self.complexity - path.node.complexity + substituted_complexity(to_apply, captures) > max_complexity
+
+    # Whether a child of the same type goes without parentheses.
+    nests_without_parens = True
+
+    # Expressions are immutable and shared, so copies would only break
+    # comparing them by identity.
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __str__(self):
+        # Formed once, as the expression is immutable.
+        if self._str is None:
+            self._str = self.to_string(None)
+        return self._str
+
+    def to_string(self, parent=None):
+        """Stringifies with less parentheses.
+
+        Similar to __str__, but allows for omitting unneeded parentheses.
+        Parts of the string (see string_parts) are expanded with a stack
+        and joined once.
+
+        Args:
+            parent (class): The class of the parent of this expression node.
+
+        Returns:
+            str: __str__
+        """
+        fragments = []
+        stack = [(self, parent)]
+        while stack:
+            part = stack.pop()
+            if type(part) is str:
+                fragments.append(part)
+            else:
+                stack.extend(reversed(part[0].string_parts(part[1])))
+        return ''.join(fragments)
+
+    def to_bdd(self):
+        """Retrieve the decision diagram of the expression.
+
+        The reduced ordered decision diagram is canonical, so equivalent
+        expressions have the same diagram. It's formed when first needed
+        and kept with the expression, as are the ones of subexpressions.
+
+        Returns:
+            BddNode: The root of the diagram.
+        """
+        if self._bdd is None:
+            # In postorder, so children are always done first.
+            for e in self:
+                if e._bdd is None:
+                    e._bdd = e._compute_bdd()
+        return self._bdd
+
+    def get_truth_table_program(self):
+        """Retrieve the program computing the truth table of the expression.
+
+        The program is a flat sequence of instructions of nodes in postorder,
+        so evaluation doesn't recurse through the tree. It's formed when
+        first needed and kept with the expression.
+
+        Returns:
+            tuple of (int, object): Instructions of subsequent nodes.
+        """
+        if self._truth_table_program is None:
+            self._truth_table_program = tuple(e.truth_table_instruction() for e in self)
+        return self._truth_table_program
+
     def try_simplify_by_evaluation(self, lut=None):
         """Try simplify the expression by evaluating subtrees.
 
@@ -293,12 +712,25 @@ class Expression:
             Expression: Either a newly formed, simplified expression, an
                 expression from lookup table, or self if nothing can be done.
         """
-        if lut:
-            simplified = lut(self)
-            if not simplified is self:
-                return simplified
+        # Expressions are immutable and shared, so a subtree appearing
+        # in many places (or many expressions) is simplified only once.
+        if self._simplified is None:
+            self._simplified = dict()
+        elif lut in self._simplified:
+            return self._simplified[lut]
+
+        simplified = lut(self) if lut else self
+        if simplified is self:
+            simplified = self.try_simplify_by_children_evaluation(lut)
+        elif simplified._simplified is None:
+            # Expressions from the lookup table are already the simplest,
+            # so when met again neither the lookup nor children are visited.
+            simplified._simplified = {lut: simplified}
+        else:
+            simplified._simplified.setdefault(lut, simplified)
 
-        return self.try_simplify_by_children_evaluation(lut)
+        self._simplified[lut] = simplified
+        return simplified
 
     def __repr__(self):
         """Stringify into a tree form.
@@ -309,13 +741,42 @@ class Expression:
         Returns:
             str: Representaton
         """
-        indentation = '    '
-        return ''.join(
-            [
-                'Type: {0}; Complexity: {1}; Children:\n'.format(self.__class__.__name__, self.complexity),
-                textwrap.indent('\n'.join(repr(e) for e in self.children()), indentation)
-            ]
-        )
+        # Nodes are listed in preorder, each line indented by its depth.
+        lines = []
+        stack = [(self, '')]
+        while stack:
+            e, indentation = stack.pop()
+            children = e.children()
+            if not children:
+                lines.append(indentation + repr(e))
+                continue
+            lines.append('{0}Type: {1}; Complexity: {2}; Children:'.format(indentation, e.__class__.__name__, e.complexity))
+            child_indentation = indentation + '    '
+            stack.extend((child, child_indentation) for child in reversed(children))
+        return '\n'.join(lines)
+
+    def apply_pattern_after_path(self, to_match, to_apply, path_captures):
+        """Apply pattern after path with captures.
+
+        Makes a substitution at the end of the path and rebuilds the nodes
+        along the path bottom-up, forming a new expression (unchanged parts
+        are reused due to immutability).
+
+        Args:
+            to_match (Expression): Expression to match. Currently unused.
+            to_apply (Expression): Expression to substitute into at the end.
+            path_captures ((PathNode, dict of (str, Expression)) pair):
+                path to the matching node and captures to substitute into it.
+
+        Returns:
+            A new expression after substitution.
+        """
+        path, captures = path_captures
+        new_node = to_apply.substitute(captures)
+        while path.parent:
+            new_node = path.parent.node.replace_child(path.index, new_node)
+            path = path.parent
+        return new_node
 
     def children(self):
         """Retrieve all children of the node.
@@ -324,9 +785,9 @@ class Expression:
         Base expression doesn't have any children.
 
         Returns:
-            list: All children expressions
+            tuple: All children expressions
         """
-        return []
+        return ()
 
 class Constant(Expression):
     """A constant boolean expression.
@@ -334,17 +795,20 @@ class Constant(Expression):
     Represents either True or False.
     """
 
+    __slots__ = ('_value',)
+
     self_complexity = -1
     """Complexity the node adds to the expression."""
 
-    _instances = dict()
+    _instances = weakref.WeakValueDictionary()
 
     def __new__(cls, value):
-        if value not in cls._instances:
+        instance = cls._instances.get(value)
+        if instance is None:
             instance = super().__new__(cls)
             instance._initialized = False
             cls._instances[value] = instance
-        return cls._instances[value]
+        return instance
 
     def __init__(self, value):
         """Initialize to a given value.
@@ -362,9 +826,18 @@ class Constant(Expression):
         self._value = value
         self._complexity = self.__compute_complexity()
         self._hash = self.__compute_hash()
+        self._symbols = frozenset()
+        self._fingerprint = mask(FINGERPRINT_BITS) if value else 0
+        self._simplified = None
+        self._truth_table_program = None
+        self._str = None
+        self._bdd = None
 
     def __iter__(self):
-        yield self
+        return iter(self._get_postorder())
+
+    def _get_postorder(self):
+        return (self,)
 
     @property
     def value(self):
@@ -376,106 +849,67 @@ class Constant(Expression):
         """The complexity of the whole expression."""
         return self._complexity
 
-    def evaluate(self, variables):
-        """Return boolean value of this constant."""
-        return self._value
-
-    def __str__(self):
-        return str(self.value)
-
-    def __repr__(self):
-        return 'Constant: {0}'.format(self.value)
-
-    def to_string(self, parent):
-        """Stringifies with less parentheses.
-
-        Similar to __str__, but allows for omitting unneeded parentheses.
-
-        Args:
-            parent (class): The class of the parent of this expression node.
+    @property
+    def semantic_fingerprint(self):
+        """Values of the expression for a fixed set of pseudo-random inputs.
 
-        Returns:
-            str: __str__
+        Expressions that are always equal have equal fingerprints,
+        so differing fingerprints prove that expressions are not equal.
+        The inputs are given by fingerprint_column.
         """
-        return str(self.value)
+        return self._fingerprint
 
-    def __eq__(self, other):
-        return type(other) == Constant and self.value == other.value
+    @property
+    def symbols(self):
+        """Names of the distinct symbols used in the expression.
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+        Formed from the symbols of children when the expression is created.
+        """
+        return self._symbols
 
-    def try_match_once(self, pattern, captures):
-        """Try match the node with the given pattern.
+    def evaluate(self, variables):
+        """Return boolean value of this constant."""
+        return self._value
 
-        Tries to match the node with expression given in pattern.
-        Updates captures if pattern is a symbol.
-        Can modify captures even on failure.
-        Does at most one match.
+    def truth_table_instruction(self):
+        """Retrieve the instruction computing the truth table of the node.
 
-        Args:
-            pattern (Expression): Expression to try match against.
-            captures (dict of (str, Expression)): captures from previous
-                matches of the same pattern.
+        Instructions of the nodes in postorder form the truth table
+        program of an expression, see get_truth_table_program.
 
         Returns:
-            bool: True if the match was successful, False otherwise.
+            (int, object) pair: Kind of the instruction and its argument.
         """
-        if type(pattern) is Symbol:
-            return add_if_no_conflict(captures, pattern.name, self)
-        elif type(pattern) is Constant:
-            return self.value == pattern.value
-        else:
-            return False
+        return (_TT_CONSTANT, -1 if self._value else 0)
 
-    def try_match_all(self, pattern, prev_captures):
-        """Try match the node with the given pattern.
-
-        Similar as try_match_ones, but is made in a form of a generator that
-        can report multiple matches per node.
-
-        prev_captures is never modified.
-
-        Args:
-            pattern (Expression): Expression to try match against.
-            prev_captures (dict of (str, Expression)): captures from previous
-                matches of the same pattern.
+    def _compute_bdd(self):
+        return bdd_constant(self._value)
 
-        Yields:
-            (bool, (dict of (str, Expression)): A boolean indicating whether
-                the match was successful and a copy of captures made during
-                the matching.
+    def __repr__(self):
+        return 'Constant: {0}'.format(self.value)
 
-        """
-        if type(pattern) is Symbol:
-            captures = prev_captures.copy()
-            yield (add_if_no_conflict(captures, pattern.name, self), captures)
-        elif type(pattern) is Constant:
-            captures = prev_captures.copy()
-            yield (self.value == pattern.value, captures)
-        else:
-            yield (False, prev_captures)
+    def __reduce__(self):
+        # Unpickled through the constructor, so it's shared again.
+        return (Constant, (self._value,))
 
-    def apply_pattern_after_path(self, to_match, to_apply, path_captures):
-        """Apply pattern after path with captures.
+    def string_parts(self, parent):
+        """Split the string representation into parts.
 
-        Traverses the expression according to the path and at the end
-        makes a substitution forming a new expression (unchanged parts
-        are reused due to immutability).
+        Used by to_string. Parts are either strings or (child, parent class)
+        pairs standing for the string representation of the child.
 
         Args:
-            to_match (Expression): Expression to match. Currently unused.
-            to_apply (Expression): Expression to substitute into at the end.
-            path_captures ((list of Expression, dict of (str, Expression)) pair):
-                path to the matching node and captures to substitute into it.
+            parent (class): The class of the parent of this expression node.
 
         Returns:
-            A new expression after substitution.
+            list: Parts in order.
         """
-        captures = path_captures[1]
-        return to_apply.substitute(captures)
+        return [str(self._value)]
+
+    def _match_same(self, pattern, captures):
+        return self._value == pattern._value
 
-    def gather_paths_to_some_matches(self, pattern, all_paths, current_path):
+    def gather_paths_to_some_matches(self, pattern, all_paths, current_path, index=None):
         """Gather paths and captures to matching nodes.
 
         See get_paths_to_some_matches.
@@ -485,29 +919,24 @@ class Constant(Expression):
 
         Args:
             pattern (Expression): Expression to match against.
-            all_paths (list of list of Expression): Already saved paths.
-            current_path (list of Expression): Path to the current node.
+            all_paths (list of (PathNode, dict)): Already saved paths.
+            current_path (PathNode): Path to the parent node.
         """
         captures = dict()
         if self.try_match_once(pattern, captures):
-            current_path += [self]
-            all_paths += [(current_path.copy(), captures)]
-            current_path.pop()
+            all_paths.append((PathNode.extend(current_path, self, index), captures))
 
-    def gather_paths_to_all_matches(self, pattern, all_paths, current_path):
+    def gather_paths_to_all_matches(self, pattern, all_paths, current_path, index=None):
         """Gather paths and captures to matching nodes.
 
         Same as gather_paths_to_some_matches, but can add multiple
-        paths (captures) for one node.
+        paths (captures) for one node. Matching is done by a MatchProgram
+        compiled from the pattern.
         """
-        current_path += [self]
+        current_path = PathNode.extend(current_path, self, index)
 
-        current_path_copy = current_path.copy()
-        for v, c in self.try_match_all(pattern, dict()):
-            if v:
-                all_paths += [(current_path_copy, c)]
-
-        current_path.pop()
+        for c in compile_pattern(pattern).matches(self):
+            all_paths.append((current_path, c))
 
     def substitute(self, variables):
         """Substitute variables into the expression.
@@ -525,7 +954,7 @@ class Constant(Expression):
         return self.self_complexity
 
     def __compute_hash(self):
-        return hash((self.value, type(self)))
+        return hash((self.value, _name_hash(type(self).__name__)))
 
     def __hash__(self):
         return self._hash
@@ -539,17 +968,25 @@ class Constant(Expression):
         return self
 
 
+# Constants are interned anyway, these are kept for cheap access.
+TRUE = Constant(True)
+FALSE = Constant(False)
+
+
 class Symbol(Expression):
+    __slots__ = ('_name',)
+
     self_complexity = 0
 
-    _instances = dict()
+    _instances = weakref.WeakValueDictionary()
 
     def __new__(cls, name):
-        if name not in cls._instances:
+        instance = cls._instances.get(name)
+        if instance is None:
             instance = super().__new__(cls)
             instance._initialized = False
             cls._instances[name] = instance
-        return cls._instances[name]
+        return instance
 
     def __init__(self, name):
         if self._initialized:
@@ -559,9 +996,18 @@ class Symbol(Expression):
         self._name = name
         self._complexity = self.__compute_complexity();
         self._hash = self.__compute_hash()
+        self._symbols = frozenset((name,))
+        self._fingerprint = fingerprint_column(name)
+        self._simplified = None
+        self._truth_table_program = None
+        self._str = None
+        self._bdd = None
 
     def __iter__(self):
-        yield self
+        return iter(self._get_postorder())
+
+    def _get_postorder(self):
+        return (self,)
 
     @property
     def name(self):
@@ -571,66 +1017,54 @@ class Symbol(Expression):
     def complexity(self):
         return self._complexity
 
-    def evaluate(self, variables):
-        return variables[self.name]
+    @property
+    def semantic_fingerprint(self):
+        return self._fingerprint
 
-    def __str__(self):
-        return self.name
+    @property
+    def symbols(self):
+        return self._symbols
 
-    def __repr__(self):
-        return 'Symbol: {0}'.format(self.name)
+    def evaluate(self, variables):
+        return variables[self._name]
 
-    def to_string(self, parent):
-        return self.name
+    def truth_table_instruction(self):
+        return (_TT_VARIABLE, self._name)
 
-    def __eq__(self, other):
-        return type(other) == Symbol and self.name == other.name
+    def _compute_bdd(self):
+        return bdd_variable(self._name)
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    def __repr__(self):
+        return 'Symbol: {0}'.format(self.name)
 
-    def try_match_once(self, pattern, captures):
-        if type(pattern) is Symbol:
-            return add_if_no_conflict(captures, pattern.name, self)
-        else:
-            return False
+    def __reduce__(self):
+        return (Symbol, (self._name,))
 
-    def try_match_all(self, pattern, prev_captures):
-        if type(pattern) is Symbol:
-            captures = prev_captures.copy()
-            yield (add_if_no_conflict(captures, pattern.name, self), captures)
-        else:
-            yield (False, prev_captures)
+    def string_parts(self, parent):
+        return [self._name]
 
-    def apply_pattern_after_path(self, to_match, to_apply, path_captures):
-        captures = path_captures[1]
-        return to_apply.substitute(captures)
+    def _match_same(self, pattern, captures):
+        return add_if_no_conflict(captures, pattern._name, self)
 
-    def gather_paths_to_some_matches(self, pattern, all_paths, current_path):
+    def gather_paths_to_some_matches(self, pattern, all_paths, current_path, index=None):
         captures = dict()
         if self.try_match_once(pattern, captures):
-            current_path += [self]
-            all_paths += [(current_path.copy(), captures)]
-            current_path.pop()
-
-    def gather_paths_to_all_matches(self, pattern, all_paths, current_path):
-        current_path += [self]
+            all_paths.append((PathNode.extend(current_path, self, index), captures))
 
-        current_path_copy = current_path.copy()
-        for v, c in self.try_match_all(pattern, dict()):
-            if v:
-                all_paths += [(current_path_copy, c)]
+    def gather_paths_to_all_matches(self, pattern, all_paths, current_path, index=None):
+        current_path = PathNode.extend(current_path, self, index)
 
-        current_path.pop()
+        for c in compile_pattern(pattern).matches(self):
+            all_paths.append((current_path, c))
 
     def substitute(self, variables):
-        return variables[self.name]
+        return variables[self._name]
 
     def __compute_complexity(self):
         return self.self_complexity
 
     def __compute_hash(self):
-        return hash((self.name, type(self)))
+        return hash((_name_hash(self.name), _name_hash(type(self).__name__)))
 
     def __hash__(self):
         return self._hash
@@ -639,16 +1073,76 @@ class Symbol(Expression):
         return self
 
 
+def _flatten_postorder(expr):
+    # Flattens the operator and all its operator descendants that are
+    # not flattened yet, children first, without recursion.
+    stack = [expr]
+    while stack:
+        e = stack[-1]
+        if e._postorder is not None:
+            stack.pop()
+            continue
+        pending = [c for c in e._children if c.children() and c._postorder is None]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        postorder = []
+        for c in e._children:
+            postorder.extend(c._get_postorder())
+        postorder.append(e)
+        e._postorder = tuple(postorder)
+
 class UnaryOperator(Expression):
+    __slots__ = ('_arg', '_children', '_postorder')
+
     def __iter__(self):
-        for e in self.arg:
-            yield e
-        yield self
+        return iter(self._get_postorder())
+
+    def _get_postorder(self):
+        # Flattened lazily, most expressions are never iterated over.
+        if self._postorder is None:
+            _flatten_postorder(self)
+        return self._postorder
+
+    # Structurally equal operators are shared. Children are already
+    # shared, so they can be told apart by identity. Entries live only as
+    # long as the operator does, which keeps the ids of its children valid.
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, arg):
+        key = (cls, id(arg))
+        instance = UnaryOperator._instances.get(key)
+        if instance is None:
+            instance = super().__new__(cls)
+            instance._initialized = False
+            UnaryOperator._instances[key] = instance
+        return instance
+
+    def truth_table_instruction(self):
+        return (_TT_UNARY, self.truth_table_op)
+
+    def _compute_bdd(self):
+        return bdd_apply_unary(self.truth_table_op, self._arg._bdd)
 
     def __init__(self, arg):
+        if self._initialized:
+            return
+        self._initialized = True
+
         self._arg = arg
-        self._complexity = self.__compute_complexity();
-        self._hash = self.__compute_hash()
+        self._children = (arg,)
+        self._postorder = None
+        # Both are formed from the ones of the child, which are already
+        # computed. Type names are used, as hashes of types differ between runs.
+        self._complexity = self.self_complexity + arg._complexity
+        self._hash = hash((_name_hash(type(self).__name__), arg._hash))
+        self._symbols = arg._symbols
+        self._fingerprint = self.truth_table_op(arg._fingerprint) & mask(FINGERPRINT_BITS)
+        self._simplified = None
+        self._truth_table_program = None
+        self._str = None
+        self._bdd = None
 
     @property
     def arg(self):
@@ -658,83 +1152,179 @@ class UnaryOperator(Expression):
     def complexity(self):
         return self._complexity
 
-    def try_match_once(self, pattern, captures):
-        if type(pattern) is Symbol:
-            return add_if_no_conflict(captures, pattern.name, self)
-        elif type(pattern) is type(self):
-            return self._arg.try_match_once(pattern.arg, captures)
-        else:
-            return False
+    @property
+    def semantic_fingerprint(self):
+        return self._fingerprint
 
-    def try_match_all(self, pattern, prev_captures):
-        if type(pattern) is Symbol:
-            captures = prev_captures.copy()
-            yield (add_if_no_conflict(captures, pattern.name, self), captures)
-        elif type(pattern) is type(self):
-            captures = prev_captures.copy()
-            for v, c in self._arg.try_match_all(pattern.arg, captures):
-                if v:
-                    yield (v, c)
-        else:
-            return False
+    @property
+    def symbols(self):
+        return self._symbols
+
+    def _match_same(self, pattern, captures):
+        return self._arg.try_match_once(pattern._arg, captures)
 
-    def gather_paths_to_some_matches(self, pattern, all_paths, current_path):
-        current_path += [self]
+    def gather_paths_to_some_matches(self, pattern, all_paths, current_path, index=None):
+        current_path = PathNode.extend(current_path, self, index)
 
         captures = dict()
         if self.try_match_once(pattern, captures):
-            all_paths += [(current_path.copy(), captures)]
+            all_paths.append((current_path, captures))
 
-        self._arg.gather_paths_to_some_matches(pattern, all_paths, current_path)
+        self._arg.gather_paths_to_some_matches(pattern, all_paths, current_path, 0)
 
-        current_path.pop()
+    def gather_paths_to_all_matches(self, pattern, all_paths, current_path, index=None):
+        current_path = PathNode.extend(current_path, self, index)
 
-    def gather_paths_to_all_matches(self, pattern, all_paths, current_path):
-        current_path += [self]
+        for c in compile_pattern(pattern).matches(self):
+            all_paths.append((current_path, c))
 
-        current_path_copy = current_path.copy()
-        for v, c in self.try_match_all(pattern, dict()):
-            if v:
-                all_paths += [(current_path_copy, c)]
-
-        self._arg.gather_paths_to_all_matches(pattern, all_paths, current_path)
-
-        current_path.pop()
+        self._arg.gather_paths_to_all_matches(pattern, all_paths, current_path, 0)
 
     def substitute(self, variables):
+        if not self._symbols:
+            return self
         return type(self)(self._arg.substitute(variables))
 
-    def apply_pattern_after_path(self, to_match, to_apply, path_captures):
-        path = path_captures[0]
-        captures = path_captures[1]
-        if len(path) == 1:
-            return to_apply.substitute(captures)
-        else:
-            return type(self)(self._arg.apply_pattern_after_path(to_match, to_apply, [path[1:], captures]))
+    def replace_child(self, index, new_child):
+        """Form a copy of the node with one child replaced.
 
-    def __compute_complexity(self):
-        return self.self_complexity + self._arg.complexity
+        Only operators have children, so only they can be parents
+        on a path (see apply_pattern_after_path).
 
-    def __compute_hash(self):
-        return hash((self._arg, type(self)))
+        Args:
+            index (int): Position of the child to replace (as in children).
+            new_child (Expression): The child to put in its place.
+
+        Returns:
+            Expression: The new node.
+        """
+        return type(self)(new_child)
+
+    def __reduce__(self):
+        return (type(self), (self._arg,))
+
+    def string_parts(self, parent):
+        cls = type(self)
+        # Only parentheses depend on the parent, so a string formed
+        # before is reused.
+        parts = [self._str] if self._str is not None else [self.token, (self._arg, cls)]
+        if self._bare_under[parent]:
+            return parts
+        return ['(', *parts, ')']
 
     def children(self):
-        return [self._arg]
+        return self._children
+
+
+def _constant_kind(expr):
+    # Children that are constant without being a Constant node count
+    # as well. Fingerprints rule out most of them without evaluating.
+    if expr is FALSE or evaluates_to(expr, False):
+        return 0
+    if expr is TRUE or evaluates_to(expr, True):
+        return 1
+    return 2
+
+def _constant_simplifications(if_lhs_true, if_lhs_false, if_rhs_true, if_rhs_false):
+    # Maps kinds of children (see _constant_kind) to simplifications,
+    # each taking the other child. Constant lhs takes precedence.
+    simplifications = dict()
+    for kind in range(3):
+        simplifications[(1, kind)] = lambda l, r: if_lhs_true(r)
+        simplifications[(0, kind)] = lambda l, r: if_lhs_false(r)
+    simplifications[(2, 1)] = lambda l, r: if_rhs_true(l)
+    simplifications[(2, 0)] = lambda l, r: if_rhs_false(l)
+    return simplifications
+
+def _balanced_fold(cls, exprs):
+    # Joins neighbours pairwise, level by level, which gives
+    # a balanced tree without recursion or slicing.
+    level = list(exprs)
+    while len(level) > 1:
+        level = [cls(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+    return level[0]
+
+def _associative_fold(cls, exprs):
+    # Flattens nested operators of the same type and joins each distinct
+    # operand once, in order of appearance. An operand together with
+    # its negation makes the whole the opposite simplification.
+    # No operands make the identity element of the operator.
+    operands = []
+    present = set()
+    stack = list(exprs)[::-1]
+    while stack:
+        e = stack.pop()
+        if type(e) is cls:
+            stack.append(e._rhs)
+            stack.append(e._lhs)
+        elif e not in present:
+            present.add(e)
+            operands.append(e)
+
+    for e in operands:
+        if type(e) is Negation and e._arg in present:
+            return cls._simplify_opposite(e._arg, e)
+
+    if not operands:
+        return cls._identity
+
+    return _balanced_fold(cls, operands)
+
+def _simplest_of(l, r):
+    # The one using fewer distinct symbols, lhs on ties.
+    return l if len(l._symbols) <= len(r._symbols) else r
 
 
 class BinaryOperator(Expression):
+    __slots__ = ('_lhs', '_rhs', '_children', '_postorder')
+
+    # Type of the child absorbed by the other child, if any.
+    _absorbed = None
+
     def __iter__(self):
-        for e in self.lhs:
-            yield e
-        for e in self.rhs:
-            yield e
-        yield self
+        return iter(self._get_postorder())
+
+    def _get_postorder(self):
+        if self._postorder is None:
+            _flatten_postorder(self)
+        return self._postorder
+
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, lhs, rhs):
+        key = (cls, id(lhs), id(rhs))
+        instance = BinaryOperator._instances.get(key)
+        if instance is None:
+            instance = super().__new__(cls)
+            instance._initialized = False
+            BinaryOperator._instances[key] = instance
+        return instance
+
+    def truth_table_instruction(self):
+        return (_TT_BINARY, self.truth_table_op)
+
+    def _compute_bdd(self):
+        return bdd_apply(self.truth_table_op, self._lhs._bdd, self._rhs._bdd)
 
     def __init__(self, lhs, rhs):
+        if self._initialized:
+            return
+        self._initialized = True
+
         self._lhs = lhs
         self._rhs = rhs
-        self._complexity = self.__compute_complexity();
-        self._hash = self.__compute_hash()
+        self._children = (lhs, rhs)
+        self._postorder = None
+        # As for UnaryOperator. Symmetric operators already have
+        # their operands ordered here.
+        self._complexity = self.self_complexity + lhs._complexity + rhs._complexity
+        self._hash = hash((_name_hash(type(self).__name__), lhs._hash, rhs._hash))
+        self._symbols = lhs._symbols | rhs._symbols
+        self._fingerprint = self.truth_table_op(lhs._fingerprint, rhs._fingerprint) & mask(FINGERPRINT_BITS)
+        self._simplified = None
+        self._truth_table_program = None
+        self._str = None
+        self._bdd = None
 
     @property
     def lhs(self):
@@ -748,74 +1338,78 @@ class BinaryOperator(Expression):
     def complexity(self):
         return self._complexity
 
-    def try_match_once(self, pattern, captures):
-        t = type(pattern)
-        if t is Symbol:
-            return add_if_no_conflict(captures, pattern.name, self)
-        elif t is type(self):
-            return self._lhs.try_match_once(pattern.lhs, captures) and self._rhs.try_match_once(pattern.rhs, captures)
-        else:
-            return False
+    @property
+    def semantic_fingerprint(self):
+        return self._fingerprint
 
-    def try_match_all(self, pattern, prev_captures):
-        t = type(pattern)
-        if t is Symbol:
-            captures = prev_captures.copy()
-            yield (add_if_no_conflict(captures, pattern.name, self), captures)
-        elif t is type(self):
-            captures = prev_captures.copy()
-            for v, c in self._lhs.try_match_all(pattern.lhs, captures):
-                if v:
-                    c_copy = c.copy()
-                    for v2, c2 in self._rhs.try_match_all(pattern.rhs, c_copy):
-                        if v2:
-                            yield (v2, c2)
-        else:
-            yield (False, prev_captures)
+    @property
+    def symbols(self):
+        return self._symbols
 
-    def gather_paths_to_some_matches(self, pattern, all_paths, current_path):
-        current_path += [self]
+    def _match_same(self, pattern, captures):
+        return self._lhs.try_match_once(pattern._lhs, captures) and self._rhs.try_match_once(pattern._rhs, captures)
+
+    def gather_paths_to_some_matches(self, pattern, all_paths, current_path, index=None):
+        current_path = PathNode.extend(current_path, self, index)
 
         captures = dict()
         if self.try_match_once(pattern, captures):
-            all_paths += [(current_path.copy(), captures)]
-
-        self._lhs.gather_paths_to_some_matches(pattern, all_paths, current_path)
-        self._rhs.gather_paths_to_some_matches(pattern, all_paths, current_path)
+            all_paths.append((current_path, captures))
 
-        current_path.pop()
+        self._lhs.gather_paths_to_some_matches(pattern, all_paths, current_path, 0)
+        self._rhs.gather_paths_to_some_matches(pattern, all_paths, current_path, 1)
 
-    def gather_paths_to_all_matches(self, pattern, all_paths, current_path):
-        current_path += [self]
+    def gather_paths_to_all_matches(self, pattern, all_paths, current_path, index=None):
+        current_path = PathNode.extend(current_path, self, index)
 
-        current_path_copy = current_path.copy()
-        for v, c in self.try_match_all(pattern, dict()):
-            if v:
-                all_paths += [(current_path_copy, c)]
+        for c in compile_pattern(pattern).matches(self):
+            all_paths.append((current_path, c))
 
-        self._lhs.gather_paths_to_all_matches(pattern, all_paths, current_path)
-        self._rhs.gather_paths_to_all_matches(pattern, all_paths, current_path)
-
-        current_path.pop()
+        self._lhs.gather_paths_to_all_matches(pattern, all_paths, current_path, 0)
+        self._rhs.gather_paths_to_all_matches(pattern, all_paths, current_path, 1)
 
     def substitute(self, variables):
+        if not self._symbols:
+            return self
         return type(self)(self._lhs.substitute(variables), self._rhs.substitute(variables))
 
-    def apply_pattern_after_path(self, to_match, to_apply, path_captures):
-        path = path_captures[0]
-        captures = path_captures[1]
-        if len(path) == 1:
-            return to_apply.substitute(captures)
-        elif path[1] is self._lhs:
-            return type(self)(self._lhs.apply_pattern_after_path(to_match, to_apply, [path[1:], captures]), self._rhs)
+    def replace_child(self, index, new_child):
+        if index == 0:
+            return type(self)(new_child, self._rhs)
         else:
-            return type(self)(self._lhs, self._rhs.apply_pattern_after_path(to_match, to_apply, [path[1:], captures]))
+            return type(self)(self._lhs, new_child)
 
-    def __compute_complexity(self):
-        return self.self_complexity + self._lhs.complexity + self._rhs.complexity
+    def __reduce__(self):
+        return (type(self), (self._lhs, self._rhs))
 
-    def __compute_hash(self):
-        return hash((self._lhs, self._rhs, type(self)))
+    def string_parts(self, parent):
+        cls = type(self)
+        parts = [self._str] if self._str is not None else [(self._lhs, cls), self.token, (self._rhs, cls)]
+        if self._bare_under[parent]:
+            return parts
+        return ['(', *parts, ')']
+
+    def try_simplify_by_children_evaluation(self, lut):
+        # Each operator gives tables of simplifications
+        # for constant, equal and opposite children.
+        l = self._lhs.try_simplify_by_evaluation(lut)
+        r = self._rhs.try_simplify_by_evaluation(lut)
+        simplify = self._simplify_constants.get((_constant_kind(l), _constant_kind(r)))
+        if simplify:
+            return simplify(l, r)
+        # Absorption, ie. x|(x&y) = x, found by identity before evaluating.
+        elif type(r) is self._absorbed and (r._lhs is l or r._rhs is l):
+            return l
+        elif type(l) is self._absorbed and (l._lhs is r or l._rhs is r):
+            return r
+        elif are_equal_by_evaluation(l, r):
+            return self._simplify_equal(l, r)
+        elif are_opposite_by_evaluation(l, r):
+            return self._simplify_opposite(l, r)
+        elif l is not self._lhs or r is not self._rhs:
+            return type(self)(l, r)
+        else:
+            return self
 
     def get_lowest_complexity_child(self):
             if self._lhs.complexity < self._rhs.complexity:
@@ -824,15 +1418,26 @@ class BinaryOperator(Expression):
                 return self._rhs
 
     def children(self):
-        return [self._lhs, self._rhs]
+        return self._children
 
 class SymmetricBinaryOperator(BinaryOperator):
-    # sorted by hash, to because order doesn't matter
-    def __init__(self, lhs, rhs):
-        if hash(lhs) < hash(rhs):
-            BinaryOperator.__init__(self, lhs, rhs)
-        else:
-            BinaryOperator.__init__(self, rhs, lhs)
+    __slots__ = ()
+
+    # sorted by hash, because order doesn't matter. Hashes depend only on
+    # the structure and names (see _name_hash), so the order (and what
+    # patterns match) doesn't change between runs. Children are shared,
+    # so ties are broken by identity.
+    def __new__(cls, lhs, rhs):
+        lhs_hash = lhs._hash
+        rhs_hash = rhs._hash
+        if lhs_hash > rhs_hash or (lhs_hash == rhs_hash and id(lhs) > id(rhs)):
+            lhs, rhs = rhs, lhs
+        instance = BinaryOperator.__new__(cls, lhs, rhs)
+        # __init__ gets the operands in the original order,
+        # so the instance is initialized here already.
+        if not instance._initialized:
+            BinaryOperator.__init__(instance, lhs, rhs)
+        return instance
 
     # This approach comes with one disadvantage compared to permuting.
     # Namely, it can only apply once per node, so if the expression
@@ -841,86 +1446,45 @@ class SymmetricBinaryOperator(BinaryOperator):
     # as an additional heuristic to make the code run faster,
     # possibly at a cost of inability to simplify some rare expressions.
     #'''
-    def try_match_once(self, pattern, captures):
-        t = type(pattern)
-        if t is Symbol:
-            return add_if_no_conflict(captures, pattern.name, self)
-        elif t is type(self):
-            captures_copy = captures.copy()
-            if self.lhs.try_match_once(pattern.lhs, captures_copy) and self.rhs.try_match_once(pattern.rhs, captures_copy):
-                captures.update(captures_copy)
-                return True
-            else:
-                return self.lhs.try_match_once(pattern.rhs, captures) and self.rhs.try_match_once(pattern.lhs, captures)
-
+    def _match_same(self, pattern, captures):
+        captures_copy = captures.copy()
+        if self._lhs.try_match_once(pattern._lhs, captures_copy) and self._rhs.try_match_once(pattern._rhs, captures_copy):
+            captures.update(captures_copy)
+            return True
         else:
-            return False
+            return self._lhs.try_match_once(pattern._rhs, captures) and self._rhs.try_match_once(pattern._lhs, captures)
     #'''
 
-    def try_match_all(self, pattern, prev_captures):
-        t = type(pattern)
-        if t is Symbol:
-            captures = prev_captures.copy()
-            yield (add_if_no_conflict(captures, pattern.name, self), captures)
-        elif t is type(self):
-            captures = prev_captures.copy()
-            for v, c in self._lhs.try_match_all(pattern.lhs, captures):
-                if v:
-                    c_copy = c.copy()
-                    for v2, c2 in self._rhs.try_match_all(pattern.rhs, c_copy):
-                        if v2:
-                            yield (v2, c2)
-
-            captures = prev_captures.copy()
-            for v, c in self._lhs.try_match_all(pattern.rhs, captures):
-                if v:
-                    c_copy = c.copy()
-                    for v2, c2 in self._rhs.try_match_all(pattern.lhs, c_copy):
-                        if v2:
-                            yield (v2, c2)
-        else:
-            yield (False, prev_captures)
 
 class Negation(UnaryOperator):
+    __slots__ = ()
+
     precedence = 10
     self_complexity = 1
+    token = '!'
 
     def __init__(self, arg):
         UnaryOperator.__init__(self, arg)
 
     def evaluate(self, variables):
-        return not self.arg.evaluate(variables)
-
-    def __str__(self):
-        return self.to_string(None)
-
-    def to_string(self, parent):
-        return ('(!{0})' if self.__uses_parens_inside(parent) else '!{0}').format(self.arg.to_string(Negation))
+        return not self._arg.evaluate(variables)
 
-    @classmethod
-    def __uses_parens_inside(cls, parent):
-        if not parent:
-            return False
-        if parent == Negation:
-            return False
-        else:
-            return Negation.precedence <= parent.precedence
-
-    def __eq__(self, other):
-        return type(other) == Negation and self.arg == other.arg
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    @staticmethod
+    def truth_table_op(arg):
+        return ~arg
 
     def __hash__(self):
         return self._hash
 
     def try_simplify_by_children_evaluation(self, lut):
         a = self._arg.try_simplify_by_evaluation(lut)
-        if a == Constant(False):
-            return Constant(True)
-        elif a == Constant(True):
-            return Constant(False)
+        if a is FALSE:
+            return TRUE
+        elif a is TRUE:
+            return FALSE
+        elif type(a) is Negation:
+            # Double negation. The argument is already simplified.
+            return a._arg
         else:
             if not a is self.arg:
                 return Negation(a)
@@ -930,300 +1494,346 @@ class Negation(UnaryOperator):
 
 
 class Disjunction(SymmetricBinaryOperator):
+    __slots__ = ()
+
     precedence = 8
     self_complexity = 3
+    token = '|'
 
     @classmethod
     def of(cls, exprs):
-        if len(exprs) == 1:
-            return exprs[0]
-        else:
-            mid = len(exprs) // 2
-            return Disjunction(Disjunction.of(exprs[:mid]), Disjunction.of(exprs[mid:]))
+        return _associative_fold(cls, exprs)
 
     def __init__(self, lhs, rhs):
         SymmetricBinaryOperator.__init__(self, lhs, rhs)
 
     def evaluate(self, variables):
-        return self.lhs.evaluate(variables) or self.rhs.evaluate(variables)
+        return self._lhs.evaluate(variables) or self._rhs.evaluate(variables)
 
-    def __str__(self):
-        return self.to_string(None)
-
-    def to_string(self, parent):
-        this_precedence = Disjunction.precedence
-        return ('({0}|{1})' if self.__uses_parens_inside(parent) else '{0}|{1}').format(self.lhs.to_string(Disjunction), self.rhs.to_string(Disjunction))
-
-    @classmethod
-    def __uses_parens_inside(cls, parent):
-        if not parent:
-            return False
-        elif parent == Disjunction:
-            return False
-        else:
-            return Disjunction.precedence <= parent.precedence
-
-    def __eq__(self, other):
-        return type(other) == Disjunction and (self.lhs == other.lhs and self.rhs == other.rhs)
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    @staticmethod
+    def truth_table_op(lhs, rhs):
+        return lhs | rhs
 
     def __hash__(self):
         return self._hash
 
-    def try_simplify_by_children_evaluation(self, lut):
-        l = self.lhs.try_simplify_by_evaluation(lut)
-        r = self.rhs.try_simplify_by_evaluation(lut)
-        if l == Constant(True):
-            return Constant(True)
-        elif l == Constant(False):
-            return r
-        elif r == Constant(True):
-            return Constant(True)
-        elif r == Constant(False):
-            return l
-        elif are_equal_by_evaluation(l, r):
-            return min([l, r], key = lambda x: count_distinct_symbols(x))
-        elif are_opposite_by_evaluation(l, r):
-            return Constant(False)
-        else:
-            if l is not self.lhs or r is not self.rhs:
-                return Disjunction(l, r)
-            else:
-                return self
+    _simplify_constants = _constant_simplifications(
+        if_lhs_true=lambda r: TRUE,
+        if_lhs_false=lambda r: r,
+        if_rhs_true=lambda l: TRUE,
+        if_rhs_false=lambda l: l)
+    _simplify_equal = staticmethod(_simplest_of)
+    _simplify_opposite = staticmethod(lambda l, r: TRUE)
+    _identity = FALSE
 
 
 class ExclusiveDisjunction(SymmetricBinaryOperator):
+    __slots__ = ()
+
     precedence = 8
     self_complexity = 3
+    token = '^'
 
     def __init__(self, lhs, rhs):
         SymmetricBinaryOperator.__init__(self, lhs, rhs)
 
     def evaluate(self, variables):
-        return self.lhs.evaluate(variables) != self.rhs.evaluate(variables)
+        return self._lhs.evaluate(variables) != self._rhs.evaluate(variables)
 
-    def __str__(self):
-        return self.to_string(None)
-
-    def to_string(self, parent):
-        this_precedence = Disjunction.precedence
-        return ('({0}^{1})' if self.__uses_parens_inside(parent) else '{0}^{1}').format(self.lhs.to_string(ExclusiveDisjunction), self.rhs.to_string(ExclusiveDisjunction))
-
-    @classmethod
-    def __uses_parens_inside(cls, parent):
-        if not parent:
-            return False
-        elif parent == ExclusiveDisjunction:
-            return False
-        else:
-            return ExclusiveDisjunction.precedence <= parent.precedence
-
-    def __eq__(self, other):
-        return type(other) == ExclusiveDisjunction and (self.lhs == other.lhs and self.rhs == other.rhs)
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    @staticmethod
+    def truth_table_op(lhs, rhs):
+        return lhs ^ rhs
 
     def __hash__(self):
         return self._hash
 
-    def try_simplify_by_children_evaluation(self, lut):
-        l = self.lhs.try_simplify_by_evaluation(lut)
-        r = self.rhs.try_simplify_by_evaluation(lut)
-        if l == Constant(True):
-            return Negation(r)
-        elif l == Constant(False):
-            return r
-        elif r == Constant(True):
-            return Negation(l)
-        elif r == Constant(False):
-            return l
-        elif are_equal_by_evaluation(l, r):
-            return Constant(False)
-        elif are_opposite_by_evaluation(l, r):
-            return Constant(True)
-        else:
-            if l is not self.lhs or r is not self.rhs:
-                return ExclusiveDisjunction(l, r)
-            else:
-                return self
+    _simplify_constants = _constant_simplifications(
+        if_lhs_true=lambda r: Negation(r),
+        if_lhs_false=lambda r: r,
+        if_rhs_true=lambda l: Negation(l),
+        if_rhs_false=lambda l: l)
+    _simplify_equal = staticmethod(lambda l, r: FALSE)
+    _simplify_opposite = staticmethod(lambda l, r: TRUE)
 
 
 class Conjunction(SymmetricBinaryOperator):
+    __slots__ = ()
+
     precedence = 8
     self_complexity = 3
+    token = '&'
 
     @classmethod
     def of(cls, exprs):
-        if len(exprs) == 1:
-            return exprs[0]
-        else:
-            mid = len(exprs) // 2
-            return Conjunction(Conjunction.of(exprs[:mid]), Conjunction.of(exprs[mid:]))
+        return _associative_fold(cls, exprs)
 
     def __init__(self, lhs, rhs):
         SymmetricBinaryOperator.__init__(self, lhs, rhs)
 
     def evaluate(self, variables):
-        return self.lhs.evaluate(variables) and self.rhs.evaluate(variables)
+        return self._lhs.evaluate(variables) and self._rhs.evaluate(variables)
 
-    def __str__(self):
-        return self.to_string(None)
-
-    def to_string(self, parent):
-        this_precedence = Disjunction.precedence
-        return ('({0}&{1})' if self.__uses_parens_inside(parent) else '{0}&{1}').format(self.lhs.to_string(Conjunction), self.rhs.to_string(Conjunction))
-
-    @classmethod
-    def __uses_parens_inside(cls, parent):
-        if not parent:
-            return False
-        elif parent == Conjunction:
-            return False
-        else:
-            return Conjunction.precedence <= parent.precedence
-
-    def __eq__(self, other):
-        return type(other) == Conjunction and (self.lhs == other.lhs and self.rhs == other.rhs)
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    @staticmethod
+    def truth_table_op(lhs, rhs):
+        return lhs & rhs
 
     def __hash__(self):
         return self._hash
 
-    def try_simplify_by_children_evaluation(self, lut):
-        l = self.lhs.try_simplify_by_evaluation(lut)
-        r = self.rhs.try_simplify_by_evaluation(lut)
-        if l == Constant(False):
-            return Constant(False)
-        elif l == Constant(True):
-            return r
-        elif r == Constant(False):
-            return Constant(False)
-        elif r == Constant(True):
-            return l
-        elif are_equal_by_evaluation(l, r):
-            return min([l, r], key = lambda x: count_distinct_symbols(x))
-        elif are_opposite_by_evaluation(l, r):
-            return Constant(False)
-        else:
-            if l is not self.lhs or r is not self.rhs:
-                return Conjunction(l, r)
-            else:
-                return self
+    _simplify_constants = _constant_simplifications(
+        if_lhs_true=lambda r: r,
+        if_lhs_false=lambda r: FALSE,
+        if_rhs_true=lambda l: l,
+        if_rhs_false=lambda l: FALSE)
+    _simplify_equal = staticmethod(_simplest_of)
+    _simplify_opposite = staticmethod(lambda l, r: FALSE)
+    _absorbed = Disjunction
+    _identity = TRUE
 
 
 class Implication(BinaryOperator):
+    __slots__ = ()
+
     precedence = 4
     self_complexity = 3
+    token = '=>'
+    nests_without_parens = False
 
     def __init__(self, lhs, rhs):
         BinaryOperator.__init__(self, lhs, rhs)
 
     def evaluate(self, variables):
-        return (not self.lhs.evaluate(variables)) or self.rhs.evaluate(variables)
-
-    def __str__(self):
-        return self.to_string(None)
-
-    def to_string(self, parent):
-        this_precedence = Disjunction.precedence
-        return ('({0}=>{1})' if self.__uses_parens_inside(parent) else '{0}=>{1}').format(self.lhs.to_string(Implication), self.rhs.to_string(Implication))
-
-    @classmethod
-    def __uses_parens_inside(cls, parent):
-        if not parent:
-            return False
-        else:
-            return Implication.precedence <= parent.precedence
-
-    def __eq__(self, other):
-        return type(other) == Implication and (self.lhs == other.lhs and self.rhs == other.rhs)
+        return (not self._lhs.evaluate(variables)) or self._rhs.evaluate(variables)
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+    @staticmethod
+    def truth_table_op(lhs, rhs):
+        return ~lhs | rhs
 
     def __hash__(self):
         return self._hash
 
-    def try_simplify_by_children_evaluation(self, lut):
-        l = self.lhs.try_simplify_by_evaluation(lut)
-        r = self.rhs.try_simplify_by_evaluation(lut)
-        if l == Constant(True):
-            return r
-        elif l == Constant(False):
-            return Constant(True)
-        elif r == Constant(True):
-            return Constant(True)
-        elif r == Constant(False):
-            return Negation(l)
-        elif are_equal_by_evaluation(l, r):
-            return Constant(True)
-        elif are_opposite_by_evaluation(l, r):
-            return Negation(l)
-        else:
-            if l is not self.lhs or r is not self.rhs:
-                return Implication(l, r)
-            else:
-                return self
+    _simplify_constants = _constant_simplifications(
+        if_lhs_true=lambda r: r,
+        if_lhs_false=lambda r: TRUE,
+        if_rhs_true=lambda l: TRUE,
+        if_rhs_false=lambda l: Negation(l))
+    _simplify_equal = staticmethod(lambda l, r: TRUE)
+    _simplify_opposite = staticmethod(lambda l, r: Negation(l))
 
 
 class Equivalency(SymmetricBinaryOperator):
+    __slots__ = ()
+
     precedence = 4
     self_complexity = 3
+    token = '<=>'
 
     def __init__(self, lhs, rhs):
         SymmetricBinaryOperator.__init__(self, lhs, rhs)
 
     def evaluate(self, variables):
-        return self.lhs.evaluate(variables) == self.rhs.evaluate(variables)
+        return self._lhs.evaluate(variables) == self._rhs.evaluate(variables)
 
-    def __str__(self):
-        return self.to_string(None)
+    @staticmethod
+    def truth_table_op(lhs, rhs):
+        return ~(lhs ^ rhs)
 
-    def to_string(self, parent):
-        this_precedence = Disjunction.precedence
-        return ('({0}<=>{1})' if self.__uses_parens_inside(parent) else '{0}<=>{1}').format(self.lhs.to_string(Equivalency), self.rhs.to_string(Equivalency))
+    def __hash__(self):
+        return self._hash
 
-    @classmethod
-    def __uses_parens_inside(cls, parent):
-        if not parent:
-            return False
-        elif parent == Equivalency:
-            return False
-        else:
-            return Equivalency.precedence <= parent.precedence
+    _simplify_constants = _constant_simplifications(
+        if_lhs_true=lambda r: r,
+        if_lhs_false=lambda r: Negation(r),
+        if_rhs_true=lambda l: l,
+        if_rhs_false=lambda l: Negation(l))
+    _simplify_equal = staticmethod(lambda l, r: TRUE)
+    _simplify_opposite = staticmethod(lambda l, r: FALSE)
 
-    def __eq__(self, other):
-        return type(other) == Equivalency and (self.lhs == other.lhs and self.rhs == other.rhs)
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+for expression_type in (Constant, Symbol, Negation, Disjunction, ExclusiveDisjunction, Conjunction, Implication, Equivalency):
+    expression_type._match_handlers[Symbol] = expression_type._match_symbol
 
-    def __hash__(self):
-        return self._hash
+# Conjunction is not yet defined with Disjunction.
+Disjunction._absorbed = Conjunction
 
-    def try_simplify_by_children_evaluation(self, lut):
-        l = self.lhs.try_simplify_by_evaluation(lut)
-        r = self.rhs.try_simplify_by_evaluation(lut)
-        if l == Constant(True):
-            return r
-        elif l == Constant(False):
-            return Negation(r)
-        elif r == Constant(True):
-            return l
-        elif r == Constant(False):
-            return Negation(l)
-        elif are_equal_by_evaluation(l, r):
-            return Constant(True)
-        elif are_opposite_by_evaluation(l, r):
-            return Constant(False)
+# Whether the operator goes without parentheses under each parent class
+# (None for the root), see string_parts. Parentheses are needed under
+# a parent of the same or higher precedence.
+_operator_types = (Negation, Disjunction, ExclusiveDisjunction, Conjunction, Implication, Equivalency)
+for expression_type in _operator_types:
+    expression_type._bare_under = {
+        parent : parent is None
+            or (parent is expression_type and expression_type.nests_without_parens)
+            or expression_type.precedence > parent.precedence
+        for parent in (None,) + _operator_types}
+
+
+class PatternIndex:
+    """Rules grouped by the root of their patterns.
+
+    A pattern can only match a node of the same type (or the same value
+    for constants), unless it is a symbol which matches anything.
+    So for every node only a fraction of rules has to be tried.
+    """
+
+    def __init__(self, rules):
+        self._rules = list(rules)
+        self._wildcards = []
+        by_type = dict()
+        for to_match, to_apply in self._rules:
+            if type(to_match) is Symbol:
+                self._wildcards += [(to_match, to_apply)]
+            else:
+                by_type.setdefault(_switch_key(to_match), []).append((to_match, to_apply))
+
+        # Symbols go after rules for the type to keep the order of rules.
+        self._by_type = {key : rules + self._wildcards for key, rules in by_type.items()}
+
+    @property
+    def rules(self):
+        return self._rules
+
+    def rules_for(self, expr):
+        """Retrieve rules with patterns that can match the root of the expression.
+
+        Args:
+            expr (Expression): Expression to be matched.
+
+        Returns:
+            list of (Expression, Expression): (to_match, to_apply) pairs.
+        """
+        return self._by_type.get(_switch_key(expr), self._wildcards)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern):
+    """Compile a pattern into a program of the matching machine.
+
+    Compiled programs are cached, so calling it repeatedly with the
+    same pattern is cheap.
+
+    Args:
+        pattern (Expression): Expression to match against.
+
+    Returns:
+        MatchProgram: The compiled pattern.
+    """
+    return MatchProgram(pattern)
+
+def _switch_key(expr):
+    # Constants are matched by value, everything else by type.
+    return expr if type(expr) is Constant else type(expr)
+
+_CHECK, _LOAD, _BIND, _CHOOSE, _JUMP, _YIELD = range(6)
+
+class MatchProgram:
+    """A pattern compiled into instructions of a matching machine.
+
+    Registers hold nodes of the matched expression and captures are kept
+    in slots, one per symbol of the pattern. Both orders of children of
+    symmetric operators are tried by backtracking to a choice point and
+    undoing the captures made since then, so matching doesn't copy the
+    captures nor recurse.
+    Instructions:
+        (_CHECK, reg, key) - fail unless node in reg has given type (value for constants)
+        (_LOAD, dst, src, i) - load i-th child of node in src to dst
+        (_BIND, reg, slot) - capture node in reg, fail on conflicting capture
+        (_CHOOSE, pc) - continue, but come back to pc on failure
+        (_JUMP, pc) - continue at pc
+        (_YIELD,) - report a match and backtrack to find more
+    """
+
+    def __init__(self, pattern):
+        self._code = []
+        self._slot_names = []
+        self._num_registers = 1
+        self._emit(pattern, 0)
+        self._code += [(_YIELD,)]
+
+    @property
+    def slot_names(self):
+        """Names of captured symbols, in order of slots."""
+        return self._slot_names
+
+    def _emit(self, pattern, reg):
+        t = type(pattern)
+        if t is Symbol:
+            if pattern.name not in self._slot_names:
+                self._slot_names += [pattern.name]
+            self._code += [(_BIND, reg, self._slot_names.index(pattern.name))]
+        elif t is Constant:
+            self._code += [(_CHECK, reg, pattern)]
         else:
-            if l is not self.lhs or r is not self.rhs:
-                return Equivalency(l, r)
+            self._code += [(_CHECK, reg, t)]
+
+            children = pattern.children()
+            regs = list(range(self._num_registers, self._num_registers + len(children)))
+            self._num_registers += len(children)
+
+            if isinstance(pattern, SymmetricBinaryOperator):
+                choose = len(self._code)
+                self._code += [None, (_LOAD, regs[0], reg, 0), (_LOAD, regs[1], reg, 1), None]
+                self._code[choose] = (_CHOOSE, len(self._code))
+                self._code[choose + 3] = (_JUMP, len(self._code) + 2)
+                self._code += [(_LOAD, regs[0], reg, 1), (_LOAD, regs[1], reg, 0)]
             else:
-                return self
+                self._code += [(_LOAD, r, reg, i) for i, r in enumerate(regs)]
 
+            for e, r in zip(children, regs):
+                self._emit(e, r)
+
+    def run(self, expr):
+        """Match the pattern against the root of the expression.
+
+        Args:
+            expr (Expression): Expression to match.
+
+        Yields:
+            list of Expression: Captures of a match, in order of slot_names.
+        """
+        code = self._code
+        registers = [None] * self._num_registers
+        registers[0] = expr
+        slots = [None] * len(self._slot_names)
+        trail = []
+        choices = []
+        pc = 0
+        while True:
+            op = code[pc]
+            kind = op[0]
+            ok = True
+            if kind == _CHECK:
+                ok = _switch_key(registers[op[1]]) is op[2]
+                pc += 1
+            elif kind == _LOAD:
+                registers[op[1]] = registers[op[2]].children()[op[3]]
+                pc += 1
+            elif kind == _BIND:
+                value = registers[op[1]]
+                captured = slots[op[2]]
+                if captured is None:
+                    slots[op[2]] = value
+                    trail.append(op[2])
+                else:
+                    ok = captured is value or are_equal_by_evaluation(captured, value)
+                pc += 1
+            elif kind == _CHOOSE:
+                choices.append((op[1], len(trail)))
+                pc += 1
+            elif kind == _JUMP:
+                pc = op[1]
+            else:
+                yield list(slots)
+                ok = False
+
+            if not ok:
+                if not choices:
+                    return
+                pc, mark = choices.pop()
+                while len(trail) > mark:
+                    slots[trail.pop()] = None
+
+    def matches(self, expr):
+        """Same as run, but yields captures as dicts of (str, Expression)."""
+        for values in self.run(expr):
+            yield dict(zip(self._slot_names, values))
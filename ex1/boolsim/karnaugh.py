@@ -2,102 +2,152 @@ from .expression import *
 from .parser import *
 from .util import *
 
+import itertools
+
 class Region:
-    def __init__(self, start, direction, is_used):
+    __slots__ = ['start', 'direction', 'symbols', 'negations', 'is_used', 'indices', 'cells']
+
+    def __init__(self, start, direction, is_used, indices=None, cells=None):
         self.start = start
         self.direction = direction
         self.symbols = (~direction).val
         self.negations = (~start).val
         self.is_used = is_used
+        # indices of cells in the region
+        self.indices = indices if indices is not None else list(volume2(start.val, direction))
+        # the same cells as bits
+        if cells is None:
+            cells = 0
+            for index in self.indices:
+                cells |= pow2(index)
+        self.cells = cells
+
+# maps the digits of a binary string to cell values, and cell values to their negations
+_cells_from_digits = bytes.maketrans(b'01', b'\x00\x01')
+_inverted_cells = bytes.maketrans(b'\x00\x01', b'\x01\x00')
 
 class KarnaughMap:
-    @classmethod
-    def _fill(cls, ids_to_symbols, expr):
-        dim = len(ids_to_symbols)
-        return evaluate_all(expr, ids_to_symbols)
-
     @classmethod
     def from_expression(cls, expr):
         ids_to_symbols = gather_symbols_from_expr(expr)
 
         dim = len(ids_to_symbols)
-        table = KarnaughMap._fill(ids_to_symbols, expr)
+        # evaluated once for all inputs, the table is unpacked from the bits
+        bits = evaluate_truth_table(expr, ids_to_symbols)
+        table = format(bits, '0{0}b'.format(pow2(dim)))[::-1].encode().translate(_cells_from_digits)
 
-        return KarnaughMap(dim, table, ids_to_symbols)
+        return KarnaughMap(dim, table, ids_to_symbols, bits)
 
-    def __init__(self, dim, table, its):
+    def __init__(self, dim, table, its, bits=None):
         self.dim = dim
-        self.table = table
+        # one byte (0 or 1) per cell
+        self.table = bytes(table)
         self.ids_to_symbols = its
+        # the table packed into bits of an int, so whole regions
+        # can be checked with a few bitwise operations
+        if bits is None:
+            bits = int(''.join('1' if x else '0' for x in reversed(table)), 2) if table else 0
+        self._bits = bits
+        # (positive, negated) literal of each variable, shared by all regions
+        self._literals = [(Symbol(s), Negation(Symbol(s))) for s in its]
 
     def __eq__(self, other):
         return self.table == other.table and self.ids_to_symbols == other.ids_to_symbols
 
     def __invert__(self):
-        return KarnaughMap(self.dim, [(not x) for x in self.table], self.ids_to_symbols)
+        return KarnaughMap(self.dim, self.table.translate(_inverted_cells), self.ids_to_symbols, ~self._bits & mask(len(self.table)))
 
     def __neq__(self, other):
         return not self.__eq__(other)
 
     def is_true(self):
-        return all(self.table)
+        return not self.table.count(0)
 
     def is_false(self):
-        return self.table.count(False) == len(self.table)
+        return not self.table.count(1)
 
     def _gather_regions(self):
         regions = []
+        add_region = regions.append
+
+        # read once, used in every iteration below
+        dim = self.dim
+        table = self.table
+        all_cells = mask(len(table))
+
+        visit_counts = [0] * len(table)
+        visits_left = table.count(1)
+        num_directions = 1 << dim
+        all_directions = num_directions - 1
+        # cells are bits, set in zeroes where the table is 0,
+        # in unvisited where the visit count is 0
+        # and in visited_twice where it is at least 2
+        zeroes = ~self._bits & all_cells
+        unvisited = all_cells
+        visited_twice = 0
+
+        # largest regions first, bucketed by the number of set bits
+        # (keeps increasing order within a bucket as a stable sort would)
+        directions_by_ones = [[] for _ in range(dim + 1)]
+        for direction in range(num_directions):
+            directions_by_ones[bin(direction).count('1')].append(direction)
+
+        for direction in itertools.chain.from_iterable(reversed(directions_by_ones)):
+            # starts and directions are plain ints here, only
+            # the accepted regions get BoolVectors
+            direction_vector = None
+            free = ~direction & all_directions
+            num_starting_positions = 1 << bin(free).count('1')
+            # start and direction bits are disjoint, so the cells of
+            # a region are the cells of the one starting at 0 shifted by start
+            # (offsets are all submasks of direction, in increasing order)
+            offsets = []
+            offset = 0
+            while True:
+                offsets.append(offset)
+                if offset == direction:
+                    break
+                offset = (offset - direction) & direction
+            region_at_0 = 0
+            for offset in offsets:
+                region_at_0 |= 1 << offset
 
-        visit_counts = [0] * len(self.table)
-        visits_left = self.table.count(1)
-        num_directions = pow2(self.dim)
-
-        all_directions = []
-        d = BoolVector(self.dim, 0)
-        for i in range(num_directions):
-            all_directions += [d.copy()]
-            d.increment()
-        all_directions.sort(key = lambda d : -d.ones())
-
-        for direction in all_directions:
-            num_starting_positions = pow2(direction.zeroes())
-            start = BoolVector(self.dim, 0)
+            start = 0
             for i in range(num_starting_positions):
-                all_ones = True
-                num_added_visits = 0
-                for index in volume2(start.val, direction):
-                    if self.table[index] == 0:
-                        all_ones = False
-                        break
-                    elif visit_counts[index] == 0:
-                        num_added_visits += 1
+                region_cells = region_at_0 << start
+
+                if (region_cells & zeroes) == 0:
+                    num_added_visits = bin(region_cells & unvisited).count('1')
+                    visited_twice |= region_cells & ~unvisited
+                    unvisited &= ~region_cells
 
-                if all_ones:
                     # apply the product
-                    for index in volume2(start.val, direction):
+                    indices = [start + offset for offset in offsets]
+                    for index in indices:
                         visit_counts[index] += 1
 
-                    regions += [Region(start.copy(), direction.copy(), True)]
+                    if direction_vector is None:
+                        direction_vector = BoolVector(dim, direction)
+                    add_region(Region(BoolVector(dim, start), direction_vector, True, indices, region_cells))
                     visits_left -= num_added_visits
                     if visits_left <= 0:
                         break
 
-                start.increment_masked((~direction.val) & direction.mask)
+                start = ((start | ~free) + 1) & free
 
             if visits_left <= 0:
                 break
 
         # remove unneeded regions
+        # (if all of its cells are also covered by other regions)
         for region in reversed(regions):
-            can_be_removed = True
-            for j in volume2(region.start.val, region.direction):
-                if visit_counts[j] <= 1:
-                    can_be_removed = False
-                    break
+            can_be_removed = (region.cells & ~visited_twice) == 0
 
             if can_be_removed:
-                for j in volume2(region.start.val, region.direction):
+                for j in region.indices:
                     visit_counts[j] -= 1
+                    if visit_counts[j] == 1:
+                        visited_twice &= ~pow2(j)
 
                 region.is_used = False
 
@@ -114,30 +164,29 @@ class KarnaughMap:
         for r in regions:
             if r.is_used:
                 if r.symbols == 0: # the expression doesn't depend on any variables, so it is always true
-                    return Constant(False)
+                    return FALSE
 
-                sums += [self._translate_region_into_sum(r)]
+                sums.append(self._translate_region_into_sum(r))
 
         if not sums:
-            return Constant(True)
+            return TRUE
 
         return Conjunction.of(sums)
 
     def _translate_region_into_sum(self, region):
         symbols = []
-        symbol_id = 0
         symbols_raw = region.symbols
         negations_raw = region.negations
+        # visit only set bits, lowest first
         while symbols_raw != 0:
-            if (symbols_raw & 1) == 1:
-                if (negations_raw & 1) == 0: # negations are opposite compared to the products
-                    symbols += [Negation(Symbol(self.ids_to_symbols[symbol_id]))]
-                else:
-                    symbols += [Symbol(self.ids_to_symbols[symbol_id])]
+            lowest = symbols_raw & -symbols_raw
+            positive, negated = self._literals[lowest.bit_length() - 1]
+            if (negations_raw & lowest) == 0: # negations are opposite compared to the products
+                symbols.append(negated)
+            else:
+                symbols.append(positive)
 
-            symbols_raw >>= 1
-            negations_raw >>= 1
-            symbol_id += 1
+            symbols_raw ^= lowest
 
         return Disjunction.of(symbols)
 
@@ -151,30 +200,29 @@ class KarnaughMap:
         for r in regions:
             if r.is_used:
                 if r.symbols == 0: # the expression doesn't depend on any variables, so it is always true
-                    return Constant(True)
+                    return TRUE
 
-                products += [self._translate_region_into_product(r)]
+                products.append(self._translate_region_into_product(r))
 
         if not products:
-            return Constant(False)
+            return FALSE
 
         return Disjunction.of(products)
 
 
     def _translate_region_into_product(self, region):
         symbols = []
-        symbol_id = 0
         symbols_raw = region.symbols
         negations_raw = region.negations
+        # visit only set bits, lowest first
         while symbols_raw != 0:
-            if (symbols_raw & 1) == 1:
-                if (negations_raw & 1) == 1:
-                    symbols += [Negation(Symbol(self.ids_to_symbols[symbol_id]))]
-                else:
-                    symbols += [Symbol(self.ids_to_symbols[symbol_id])]
-
-            symbols_raw >>= 1
-            negations_raw >>= 1
-            symbol_id += 1
+            lowest = symbols_raw & -symbols_raw
+            positive, negated = self._literals[lowest.bit_length() - 1]
+            if (negations_raw & lowest) != 0:
+                symbols.append(negated)
+            else:
+                symbols.append(positive)
+
+            symbols_raw ^= lowest
 
         return Conjunction.of(symbols)
\ No newline at end of file
@@ -7,13 +7,13 @@ expression_lookup_tables = [
 
     # 1D
     [
-        Constant(True),
-        Constant(False)
+        TRUE,
+        FALSE
     ],
 
     # 2D
     [
-        Constant(False),
+        FALSE,
         parse_expression('!(a|b)'),
         parse_expression('a&!b'),
         parse_expression('!b'),
@@ -28,12 +28,12 @@ expression_lookup_tables = [
         parse_expression('b'),
         parse_expression('a>b'),
         parse_expression('a|b'),
-        Constant(True)
+        TRUE
     ],
 
     # 3D
     [
-        Constant(False),
+        FALSE,
         parse_expression('!(a|b|c)'),
         parse_expression('a&!(b|c)'),
         parse_expression('!(c|b)'),
@@ -288,7 +288,7 @@ expression_lookup_tables = [
         parse_expression('b|c'),
         parse_expression('a=>b|c'),
         parse_expression('a|b|c'),
-        Constant(True)
+        TRUE
     ]
 ]
 
@@ -300,8 +300,7 @@ def bool_array_to_int(arr):
     return i
 
 def eval_to_bool(expr, ids_to_symbols):
-    dim = len(ids_to_symbols)
-    return bool_array_to_int([expr.evaluate(symbol_dict_from_index(ids_to_symbols, BoolVector(dim, i))) for i in range(pow2(dim))])
+    return evaluate_truth_table(expr, ids_to_symbols)
 
 def try_lookup_expression(expr):
     ids_to_symbols = gather_symbols_from_expr(expr)
@@ -4,7 +4,109 @@ from .util import *
 from .karnaugh import *
 from .lut import *
 from .rulesets import *
+import collections
+import functools
 import random
+import shelve
+
+class SimplificationCache:
+    """Persistent store of simplification results.
+
+    Keeps the best expressions found by FullSimplifier on disk, so they
+    are not searched for again in later runs. Entries are keyed by
+    the names of symbols and the truth table of the expression, so
+    equivalent expressions of the same symbols share one. Expressions with too many
+    symbols for a truth table are keyed by their string instead.
+    The most recently used entries are also kept in memory.
+
+    Can be used as a context manager, closing the store on exit.
+    """
+
+    def __init__(self, path, max_in_memory=1024):
+        """Open the store.
+
+        Args:
+            path (str): Path of the file the store is kept in.
+            max_in_memory (int): How many entries to keep in memory.
+        """
+        self._db = shelve.open(path)
+        self._memory = collections.OrderedDict()
+        self._max_in_memory = max_in_memory
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _key(expr):
+        ids_to_symbols = gather_symbols_from_expr(expr)
+        if len(ids_to_symbols) >= BDD_MIN_SYMBOLS:
+            return str(expr)
+        return '{0}:{1:x}'.format(','.join(ids_to_symbols), evaluate_truth_table(expr, ids_to_symbols))
+
+    def _remember(self, key, expr):
+        self._memory[key] = expr
+        self._memory.move_to_end(key)
+        if len(self._memory) > self._max_in_memory:
+            self._memory.popitem(last=False)
+
+    def get(self, expr):
+        """Retrieve the stored simplification of the expression.
+
+        Args:
+            expr (Expression): The expression to look up.
+
+        Returns:
+            Expression: The simplified expression, or None if not stored.
+        """
+        key = self._key(expr)
+        simplified = self._memory.get(key)
+        if simplified is None:
+            simplified_str = self._db.get(key)
+            if simplified_str is None:
+                return None
+            simplified = parse_expression(simplified_str)
+            # Entries from a changed or damaged store are not trusted.
+            if not are_equal_by_evaluation(expr, simplified):
+                return None
+        self._remember(key, simplified)
+        return simplified
+
+    def put(self, expr, simplified):
+        key = self._key(expr)
+        self._db[key] = str(simplified)
+        self._remember(key, simplified)
+
+    def close(self):
+        self._db.close()
+
+# Expressions are shared, so the same expression met again (for example
+# simplified again) gets the forms without building the map.
+# The form with less terms (DNF for mostly zeroes in the truth table,
+# CNF for mostly ones) is formed first. The other is only formed
+# if the first one is not already simple enough.
+@functools.lru_cache(maxsize=1024)
+def _karnaugh_forms(expr, simple_complexity):
+    km = KarnaughMap.from_expression(expr)
+    to_forms = [km.to_dnf, km.to_cnf]
+    if km.table.count(1) * 2 > len(km.table):
+        to_forms.reverse()
+
+    forms = [to_forms[0]()]
+    if forms[0].complexity > simple_complexity:
+        forms.append(to_forms[1]())
+    return tuple(forms)
+
+# Ran in worker processes, which get the rules instead of the ruleset
+# and build the index once per process.
+@functools.lru_cache(maxsize=8)
+def _rules_index(rules):
+    return PatternIndex(list(rules))
+
+def _apply_rules_recursively_to_some(rules, expr):
+    return expr.apply_rules_recursively_to_some(_rules_index(rules))
 
 # apply_pattern_recursively_to_some is used, but it can be replaced
 # with apply_pattern_recursively_to_all for better simplification
@@ -18,15 +120,24 @@ class FullSimplifier:
         confidence_factor_min_complexity=10,
         max_preserved_exprs=8,
         num_permuting_iterations=3,
-        verbosity_callback=None):
+        verbosity_callback=None,
+        cache=None,
+        executor=None):
         # confidence_factor is used to prune the expressions with much worse
         # complexity than others.
         # confidence_factor_min_complexity tells after what complexity
         # the confidence_factor can prune other expressions.
         # Ie. no expressions with complexity less than confidence_factor_min_complexity
         # will be pruned.
+        # cache is an optional SimplificationCache to reuse results
+        # of earlier runs and store the result in.
+        # executor is an optional concurrent.futures.Executor (for example
+        # a ProcessPoolExecutor) the expressions are permuted in.
 
         self._ruleset = ruleset
+        self._expr = expr
+        self._cache = cache
+        self._executor = executor
         self._is_completed = False
         self._max_preserved_expressions = max_preserved_exprs
         self._num_permuting_iterations = num_permuting_iterations
@@ -35,13 +146,20 @@ class FullSimplifier:
         # If an expression can be found in the lookup table then it is
         # guaranteed to be retrieved minimal.
         looked_up_expr = try_lookup_expression(expr)
-        if not looked_up_expr is expr:
+        is_looked_up = looked_up_expr is not expr
+        if not is_looked_up and cache:
+            # Results of earlier runs are as good as from the lookup table.
+            # The result can be the expression itself, if it was minimal.
+            cached_expr = cache.get(expr)
+            if cached_expr is not None:
+                looked_up_expr = cached_expr
+                is_looked_up = True
+        if is_looked_up:
             self._is_completed = True
             self._current_exprs = {looked_up_expr}
             self._min_complexity = looked_up_expr.complexity
         else:
-            km = KarnaughMap.from_expression(expr)
-            candidate_root_exprs = [expr.try_simplify_by_evaluation(), expr.try_simplify_by_evaluation(try_lookup_expression), km.to_dnf(), km.to_cnf()]
+            candidate_root_exprs = [expr.try_simplify_by_evaluation(), expr.try_simplify_by_evaluation(try_lookup_expression), *_karnaugh_forms(expr, confidence_factor_min_complexity)]
             self._min_complexity = min(candidate_root_exprs, key = lambda x: x.complexity).complexity
             self._current_exprs = {e for e in candidate_root_exprs if e.complexity <= max(confidence_factor_min_complexity, self._min_complexity * confidence_factor)}
 
@@ -70,8 +188,8 @@ class FullSimplifier:
 
     def _reduction_step(self):
         # Try reduce as much as possible before continuing
-        # It's guaranteed to exit the loop because all reducing_rules
-        # decrease the complexity
+        # It's guaranteed to exit the loop because only substitutions
+        # that decrease the complexity are made
         # Some are pruned to disallow potential expnential growth of number of expressions
 
         self.log('Reduction step:')
@@ -84,8 +202,9 @@ class FullSimplifier:
             new_reduced_exprs = set()
             self.log("    Reducing {0} expressions...".format(len(prev_reduced_exprs)))
             for e in prev_reduced_exprs:
-                for to_match, to_apply in self._ruleset.reducing_rules:
-                    new_reduced_exprs.update(e.apply_pattern_recursively_to_some(to_match, to_apply))
+                new_reduced_exprs.update(e.apply_rules_recursively_to_some(self._ruleset.reducing_rules_index, e.complexity - 1))
+                # The result is kept with the expression, so expressions
+                # surviving many iterations are only simplified once.
                 new_reduced_exprs.add(e.try_simplify_by_evaluation(try_lookup_expression))
 
             # hardcoded pruning
@@ -123,12 +242,21 @@ class FullSimplifier:
         for i in range(self._num_permuting_iterations):
             new_permuted_exprs = set()
             self.log('    Step {0}: Permuting {1} expressions...'.format(i, len(prev_permuted_exprs)))
-            for e in prev_permuted_exprs:
-                for to_match, to_apply in self._ruleset.permuting_rules:
-                    # apply_pattern_recursively_to_some -> apply_pattern_recursively_to_all to improve
+            # Expressions are permuted independently, so with an executor
+            # they are spread over its workers. For a few expressions
+            # it's not worth sending them there.
+            if self._executor and len(prev_permuted_exprs) > 4:
+                apply_rules = functools.partial(_apply_rules_recursively_to_some, tuple(self._ruleset.permuting_rules))
+                for permuted_exprs in self._executor.map(apply_rules, prev_permuted_exprs, chunksize=8):
+                    new_permuted_exprs.update(permuted_exprs)
+            else:
+                for e in prev_permuted_exprs:
+                    # apply_pattern_recursively_to_all for every rule instead improves
                     # coverage with an impact on speed
-                    new_permuted_exprs.update(e.apply_pattern_recursively_to_some(to_match, to_apply))
+                    new_permuted_exprs.update(e.apply_rules_recursively_to_some(self._ruleset.permuting_rules_index))
 
+            # Expressions are interned with their hashes kept, so this
+            # compares by identity and doesn't walk any trees.
             prev_permuted_exprs = new_permuted_exprs - self._current_exprs
             # Simplifying by evaluation should not be needed as much, as long as add_if_no_conflict
             # checks equality with truth table. It only accounts for subexpressions that
@@ -155,6 +283,8 @@ class FullSimplifier:
         self._min_complexity = min(self._current_exprs, key = lambda x: x.complexity).complexity
         if self._min_complexity == old:
             self._is_completed = True
+            if self._cache:
+                self._cache.put(self._expr, self.best_expr())
 
         return self
 
@@ -222,8 +352,7 @@ class Scrambler:
         for i in range(n):
             new_exprs = set()
             for e in self._all_exprs:
-                for to_match, to_apply in self._ruleset.permuting_rules:
-                    new_exprs.update(e.apply_pattern_recursively_to_some(to_match, to_apply))
+                new_exprs.update(e.apply_rules_recursively_to_some(self._ruleset.permuting_rules_index))
 
             self._all_exprs.update(new_exprs)
 
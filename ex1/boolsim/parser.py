@@ -1,5 +1,6 @@
 from enum import Enum
 from .expression import *
+import re
 
 class OpenParen:
     precedence = -1
@@ -50,6 +51,14 @@ binary_operators = [
 ]
 
 
+constants = [
+    ('0', FALSE),
+    ('1', TRUE),
+    ('False', FALSE),
+    ('True', TRUE)
+]
+
+
 class TokenType(Enum):
     CONSTANT = 0
     SYMBOL = 1
@@ -63,6 +72,8 @@ class Token:
     def __init__(self, type, token):
         self.type = type
         self.token = token
+        # only operators and parentheses have one
+        self.precedence = getattr(token, 'precedence', None)
 
     def __str__(self):
         return '(' + str(self.type) + ', ' + str(self.token) + ')'
@@ -71,103 +82,49 @@ class Token:
         return '(' + repr(self.type) + ', ' + repr(self.token) + ')'
 
 
-def try_read_constant(expr_str, pos):
-    if expr_str.startswith('0', pos):
-        return Constant(False), 1
-    elif expr_str.startswith('1', pos):
-        return Constant(True), 1
-    elif expr_str.startswith('False', pos):
-        return Constant(False), 5
-    elif expr_str.startswith('True', pos):
-        return Constant(True), 4
-    else:
-        return None, 0
-
-
-def try_read_unary_operator(expr_str, pos):
-    for s, o in unary_operators:
-        if expr_str.startswith(s, pos):
-            return o, len(s)
-
-    return None, 0
-
-
-def try_read_binary_operator(expr_str, pos):
-    for s, o in binary_operators:
-        if expr_str.startswith(s, pos):
-            return o, len(s)
-
-    return None, 0
-
-
-def try_read(expr_str, pos, to_read):
-    if expr_str.startswith(to_read, pos):
-        return to_read, len(to_read)
-
-    return None, 0
-
-
-def try_read_symbol(expr_str, pos):
-    start = pos
-    if pos < len(expr_str) and expr_str[pos].isalpha():
-        pos += 1
-    while pos < len(expr_str) and (expr_str[pos].isalpha() or expr_str[pos].isdigit()):
-        pos += 1
-
-    if pos > start:
-        return Symbol(expr_str[start:pos]), (pos - start)
-    else:
-        return None, 0
+def _alternatives(table):
+    # tried in order of the table, so longer tokens listed first win
+    return '|'.join(re.escape(s) for s, _ in table)
+
+# All kinds of tokens are tried at once, constants first, then
+# operators, symbols and parentheses. A symbol is a run of letters
+# and digits. Whitespace before a token is skipped.
+_token_regex = re.compile(
+    r'\s*(?:'
+    r'(?P<CONSTANT>' + _alternatives(constants) + r')|'
+    r'(?P<UNARY_OP>' + _alternatives(unary_operators) + r')|'
+    r'(?P<BINARY_OP>' + _alternatives(binary_operators) + r')|'
+    r'(?P<SYMBOL>[^\W_]+)|'
+    r'(?P<PAREN_OPEN>\()|'
+    r'(?P<PAREN_CLOSE>\))'
+    r')?')
+
+_token_readers = {
+    'CONSTANT' : dict(constants).__getitem__,
+    'UNARY_OP' : dict(unary_operators).__getitem__,
+    'BINARY_OP' : dict(binary_operators).__getitem__,
+    'SYMBOL' : Symbol,
+    'PAREN_OPEN' : OpenParen,
+    'PAREN_CLOSE' : CloseParen
+}
 
 
 def tokenize(expr_str):
     tokens = []
+    append = tokens.append
 
     current_pos = 0
-    while current_pos < len(expr_str):
-
-        while current_pos < len(expr_str) and expr_str[current_pos].isspace():
-            current_pos += 1
-        if current_pos == len(expr_str):
-            break;
-
-        token, length = try_read_constant(expr_str, current_pos)
-        if token:
-            current_pos += length
-            tokens += [Token(TokenType.CONSTANT, token)]
-            continue
+    while True:
+        match = _token_regex.match(expr_str, current_pos)
+        current_pos = match.end()
+        kind = match.lastgroup
+        if kind is None:
+            if current_pos == len(expr_str):
+                break
 
-        token, length = try_read_unary_operator(expr_str, current_pos)
-        if token:
-            current_pos += length
-            tokens += [Token(TokenType.UNARY_OP, token)]
-            continue
-
-        token, length = try_read_binary_operator(expr_str, current_pos)
-        if token:
-            current_pos += length
-            tokens += [Token(TokenType.BINARY_OP, token)]
-            continue
-
-        token, length = try_read_symbol(expr_str, current_pos)
-        if token:
-            current_pos += length
-            tokens += [Token(TokenType.SYMBOL, token)]
-            continue
-
-        token, length = try_read(expr_str, current_pos, '(')
-        if token:
-            current_pos += length
-            tokens += [Token(TokenType.PAREN_OPEN, OpenParen(token))]
-            continue
-
-        token, length = try_read(expr_str, current_pos, ')')
-        if token:
-            current_pos += length
-            tokens += [Token(TokenType.PAREN_CLOSE, CloseParen(token))]
-            continue
+            raise InvalidExpression('Unexpected character `{0}` at position {1}.'.format(expr_str[current_pos], current_pos))
 
-        raise InvalidExpression('Unexpected character `{0}` at position {1}.'.format(expr_str[current_pos], current_pos))
+        append(Token(TokenType[kind], _token_readers[kind](match.group(kind))))
 
     return tokens
 
@@ -196,13 +153,13 @@ def infix_to_postfix(tokens):
 
     for token in tokens:
         if token.type == TokenType.PAREN_OPEN or token.type == TokenType.UNARY_OP:
-            operator_stack += [token]
+            operator_stack.append(token)
             continue
 
         if token.type == TokenType.BINARY_OP:
-            while operator_stack and operator_stack[-1].token.precedence >= token.token.precedence:
-                postfix += [pop_operator()]
-            operator_stack += [token]
+            while operator_stack and operator_stack[-1].precedence >= token.precedence:
+                postfix.append(pop_operator())
+            operator_stack.append(token)
 
             continue
 
@@ -214,7 +171,7 @@ def infix_to_postfix(tokens):
                     finished_on_paren_open = True
                     break
 
-                postfix += [pop_operator()]
+                postfix.append(pop_operator())
 
             if not finished_on_paren_open:
                 raise InvalidExpression('Cannot match opening `(` in the expression.')
@@ -223,7 +180,7 @@ def infix_to_postfix(tokens):
 
         if token.type == TokenType.SYMBOL or token.type == TokenType.CONSTANT:
             virtual_operand_count += 1
-            postfix += [token]
+            postfix.append(token)
 
     while operator_stack:
         op = pop_operator()
@@ -231,7 +188,7 @@ def infix_to_postfix(tokens):
         if op.type == TokenType.PAREN_OPEN:
             raise InvalidExpression('Too many openning `(` in the expression.')
 
-        postfix += [op]
+        postfix.append(op)
 
     if virtual_operand_count != 1:
         raise InvalidExpression('Too few or too many operands in the expression.')
@@ -245,7 +202,7 @@ def parse_expression(expr_str):
 
     for token in tokens:
         if token.type in [TokenType.SYMBOL, TokenType.CONSTANT]:
-            operand_stack += [token.token]
+            operand_stack.append(token.token)
             continue
 
         if token.type == TokenType.UNARY_OP:
@@ -253,7 +210,7 @@ def parse_expression(expr_str):
                 raise InvalidExpression('Too few operands for unary operator.')
 
             arg = operand_stack.pop()
-            operand_stack += [token.token(arg)]
+            operand_stack.append(token.token(arg))
             continue
 
         if token.type == TokenType.BINARY_OP:
@@ -262,7 +219,7 @@ def parse_expression(expr_str):
 
             rhs = operand_stack.pop()
             lhs = operand_stack.pop()
-            operand_stack += [token.token(lhs, rhs)]
+            operand_stack.append(token.token(lhs, rhs))
 
     if len(operand_stack) != 1:
         raise InvalidExpression('Expression doesn\'t evaluate to a single value')
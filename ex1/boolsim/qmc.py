@@ -17,7 +17,8 @@ class Implicant:
         return '({0}, {1})'.format(self.minterm, self.wildcards)
 
     def __eq__(self, other):
-        return self.minterm == other.minterm and self.wildcards == other.wildcards
+        # hash is compared first as it mostly differs for different implicants
+        return other is self or (self.hash == other.hash and self.minterm == other.minterm and self.wildcards == other.wildcards)
 
     def __neq__(self, other):
         return not self.__eq__(other)
@@ -26,11 +27,15 @@ class Implicant:
         return self.hash
 
     def all_minterms(self, dim):
-        i = BoolVector(dim, self.minterm)
-        num_minterms = pow2(popcnt(self.wildcards))
-        for _ in range(num_minterms):
-            yield i.val
-            i.increment_masked_preserve_other(self.wildcards)
+        # walk all combinations of wildcard bits in increasing order
+        minterm = self.minterm
+        wildcards = self.wildcards
+        combination = 0
+        while True:
+            yield minterm | combination
+            if combination == wildcards:
+                break
+            combination = (combination - wildcards) & wildcards
 
 class Qmc:
     @classmethod
@@ -41,10 +46,13 @@ class Qmc:
         self._expr = expr
         # for testing it's good to sort ids_to_symbols
         self._ids_to_symbols = gather_symbols_from_expr(expr)
+        # (positive, negated) literal of each variable, shared by all implicants
+        self._literals = [(Symbol(s), Negation(Symbol(s))) for s in self._ids_to_symbols]
 
     def _empty_table(self):
         dim = len(self._ids_to_symbols)
-        # binned by wildcards
+        # binned by hamming weight, then by wildcards
+        # only minterms are stored, the wildcards are the key of the bin
         return [defaultdict(lambda: set()) for _ in range(dim+1)]
 
     def _gen_next_table(self, prev_table):
@@ -52,57 +60,74 @@ class Qmc:
         next_table = self._empty_table()
 
         prime_implicants = set()
-        combinable_implicants = set()
+        # minterms of implicants that were combined, binned by wildcards
+        # like the table, so no (minterm, wildcards) pairs are formed
+        combinable_implicants = defaultdict(set)
 
-        #print("MAIN LOOP START")
         # iterate all possible hamming weigths
         for hw in range(dim):
-            # pairs of implicants i1, i2
+            next_bins = next_table[hw]
+            # pairs of implicants m1, m2
             # they are further binned by wildcards
             # so only compare those with the same wildcard
-            for w, i1s in prev_table[hw].items():
-                for i1 in i1s:
-                    w = i1.wildcards
-                    i1m = i1.minterm
-                    for i2 in prev_table[hw+1][w]:
-                        # check if popcnt(x) == 1
-                        # with out storage choice it is guaranteed that at i1 and i2 are different
-                        # so x will never be 0
-                        # So amounts to just checking if x is a power of 2
-                        x = i2.minterm ^ i1m
-                        if (x & (x-1)) == 0:
+            for w, m1s in prev_table[hw].items():
+                m2s = prev_table[hw+1].get(w)
+                if not m2s:
+                    continue
+                combinable = combinable_implicants[w]
+
+                # m2 differs from m1 by exactly one bit, set in m2 only
+                # and not under a wildcard, so instead of trying all pairs
+                # only these candidates are looked up
+                free = ~w & mask(dim)
+                for m1 in m1s:
+                    candidates = free & ~m1
+                    while candidates:
+                        x = candidates & -candidates
+                        candidates ^= x
+                        m2 = m1 | x
+                        if m2 in m2s:
                             # update wildcards with bit where they differ
-                            wildcards = x | w
-                            # we can take either i1m or i2m, doesnt matterr
-                            # since the difference is under a wildcard
-                            # but we have to zero out the differing bit
+                            # m1 has this bit zeroed already
                             # (see requirement in Implicant constructor)
-                            next_table[hw][wildcards].add(Implicant(i1m & ~wildcards, wildcards))
+                            next_bins[x | w].add(m1)
 
                             # add them as combinable so we can check later which are prime
-                            combinable_implicants.add(i1)
-                            combinable_implicants.add(i2)
+                            combinable.add(m1)
+                            combinable.add(m2)
 
-        #print("MAIN LOOP END")
         for hw in range(dim+1):
-            prime_implicants.update({i for _, iss in prev_table[hw].items() for i in iss if i not in combinable_implicants})
+            prime_implicants.update({Implicant(m, w) for w, ms in prev_table[hw].items() for m in ms if m not in combinable_implicants.get(w, ())})
 
         return next_table, prime_implicants
 
     def _filter_prime_implicants(self, prime_implicants):
         dim = len(self._ids_to_symbols)
-        prime_implicant_chart = [[] for _ in range(pow2(dim))]
+        # only minterms covered by some implicant get an entry
+        prime_implicant_chart = defaultdict(list)
 
         filtered_implicants = []
 
+        # enumerated once, needed again when the implicant is picked
+        minterms_of = dict()
         for pi in prime_implicants:
-            for m in pi.all_minterms(dim):
+            minterms = minterms_of[pi] = tuple(pi.all_minterms(dim))
+            for m in minterms:
                 prime_implicant_chart[m].append(pi)
 
-        unsatisfied_minterms = {i for i, e in enumerate(prime_implicant_chart) if e}
+        # added in increasing order, as when they were found in a full chart,
+        # so ties in picking the next minterm are broken the same way
+        unsatisfied_minterms = {m for m in sorted(prime_implicant_chart)}
 
+        # Entries of the chart don't change, so the minterms can be ordered
+        # by the number of their implicants once. The sort is stable, so
+        # of those with the fewest the first in the set is picked, as min would.
+        # Satisfied ones are skipped when reached.
+        minterms_by_num_implicants = iter(sorted(unsatisfied_minterms, key=lambda x: len(prime_implicant_chart[x])))
         while unsatisfied_minterms:
-            minterm_with_min_implicants_id = min(unsatisfied_minterms, key=lambda x: len(prime_implicant_chart[x]))
+            minterm_with_min_implicants_id = next(minterms_by_num_implicants)
+            if minterm_with_min_implicants_id not in unsatisfied_minterms:
+                continue
             minterm_with_min_implicants = prime_implicant_chart[minterm_with_min_implicants_id]
 
             best_implicant = minterm_with_min_implicants[0]
@@ -110,44 +135,44 @@ class Qmc:
                 best_implicant = max(minterm_with_min_implicants, key=lambda x: popcnt(x.wildcards))
 
             filtered_implicants.append(best_implicant)
-            for m in best_implicant.all_minterms(dim):
+            for m in minterms_of[best_implicant]:
                 unsatisfied_minterms.discard(m)
 
         return filtered_implicants
 
     def _convert_implicant_to_conjunction(self, implicant):
         m = implicant.minterm
-        w = implicant.wildcards
+        # include only the symbols not under a wildcard, lowest first
+        included = ~implicant.wildcards & mask(len(self._ids_to_symbols))
 
         exprs = []
-        for s in self._ids_to_symbols:
-            if w & 1 == 0:
-                # include the symbol in the conjunction
-                if m & 1 == 1:
-                    exprs.append(Symbol(s))
-                else: # negated
-                    exprs.append(Negation(Symbol(s)))
+        while included:
+            lowest = included & -included
+            positive, negated = self._literals[lowest.bit_length() - 1]
+            if m & lowest:
+                exprs.append(positive)
+            else: # negated
+                exprs.append(negated)
 
-            m >>= 1
-            w >>= 1
+            included ^= lowest
 
         return Conjunction.of(exprs)
 
     def _convert_implicant_to_disjunction(self, implicant):
         m = implicant.minterm
-        w = implicant.wildcards
+        # include only the symbols not under a wildcard, lowest first
+        included = ~implicant.wildcards & mask(len(self._ids_to_symbols))
 
         exprs = []
-        for s in self._ids_to_symbols:
-            if w & 1 == 0:
-                # include the symbol in the conjunction
-                if m & 1 == 0:
-                    exprs.append(Symbol(s))
-                else: # negated
-                    exprs.append(Negation(Symbol(s)))
+        while included:
+            lowest = included & -included
+            positive, negated = self._literals[lowest.bit_length() - 1]
+            if m & lowest:
+                exprs.append(negated)
+            else:
+                exprs.append(positive)
 
-            m >>= 1
-            w >>= 1
+            included ^= lowest
 
         return Disjunction.of(exprs)
 
@@ -161,14 +186,19 @@ class Qmc:
 
         return Conjunction.of(disjunctions)
 
-    def _gather_prime_implicants(self, evals):
+    def _gather_prime_implicants(self, truth_table):
         #print(self._ids_to_symbols)
 
         dim = len(self._ids_to_symbols)
         current_table = self._empty_table()
-        for i, e in enumerate(evals):
-            if e:
-                current_table[popcnt(i)][0].add(Implicant(i, 0))
+        # visit only set bits of the truth table, lowest first
+        # (found in its binary digits, as masking out bits of
+        # a large int one by one takes time quadratic in its size)
+        digits = format(truth_table, 'b')[::-1]
+        i = digits.find('1')
+        while i >= 0:
+            current_table[popcnt(i)][0].add(i)
+            i = digits.find('1', i + 1)
 
         prime_implicants = set()
         while True:
@@ -188,29 +218,27 @@ class Qmc:
 
     def to_dnf(self):
         dim = len(self._ids_to_symbols)
-        evals = evaluate_all(self._expr, self._ids_to_symbols)
+        truth_table = evaluate_truth_table(self._expr, self._ids_to_symbols)
 
-        num_truths = evals.count(True)
-        if num_truths == 0:
-            return Constant(False)
-        elif num_truths == pow2(dim):
-            return Constant(True)
+        if truth_table == 0:
+            return FALSE
+        elif truth_table == mask(pow2(dim)):
+            return TRUE
 
-        filtered_prime_implicants = self._gather_prime_implicants(evals)
+        filtered_prime_implicants = self._gather_prime_implicants(truth_table)
 
         #print("Converting")
         return self._convert_implicants_to_dnf(filtered_prime_implicants)
 
     def to_cnf(self):
         dim = len(self._ids_to_symbols)
-        evals = evaluate_all(self._expr, self._ids_to_symbols)
+        truth_table = evaluate_truth_table(self._expr, self._ids_to_symbols)
 
-        num_truths = evals.count(True)
-        if num_truths == 0:
-            return Constant(False)
-        elif num_truths == pow2(dim):
-            return Constant(True)
+        if truth_table == 0:
+            return FALSE
+        elif truth_table == mask(pow2(dim)):
+            return TRUE
 
-        filtered_prime_implicants = self._gather_prime_implicants([not e for e in evals])
+        filtered_prime_implicants = self._gather_prime_implicants(truth_table ^ mask(pow2(dim)))
 
         return self._convert_implicants_to_cnf(filtered_prime_implicants)
@@ -9,6 +9,8 @@ class Ruleset:
     def __init__(self):
         self._reducing_rules = []
         self._permuting_rules = []
+        self._reducing_rules_index = None
+        self._permuting_rules_index = None
 
     def add_rule(self, to_match, to_apply, add_reverse=False, only_if=RuleType.Any):
         expr_to_match = parse_expression(to_match)
@@ -21,8 +23,10 @@ class Ruleset:
     def _add_rule(self, to_match, to_apply, only_if):
         if only_if & RuleType.Permuting and to_apply.complexity >= to_match.complexity:
             self._permuting_rules += [(to_match, to_apply)]
+            self._permuting_rules_index = None
         elif only_if & RuleType.Reducing and to_apply.complexity < to_match.complexity:
             self._reducing_rules += [(to_match, to_apply)]
+            self._reducing_rules_index = None
 
     @property
     def reducing_rules(self):
@@ -32,6 +36,18 @@ class Ruleset:
     def permuting_rules(self):
         return self._permuting_rules
 
+    @property
+    def reducing_rules_index(self):
+        if self._reducing_rules_index is None:
+            self._reducing_rules_index = PatternIndex(self._reducing_rules)
+        return self._reducing_rules_index
+
+    @property
+    def permuting_rules_index(self):
+        if self._permuting_rules_index is None:
+            self._permuting_rules_index = PatternIndex(self._permuting_rules)
+        return self._permuting_rules_index
+
 full_simplification_ruleset = Ruleset()
 # Some rules can be disabled due to methods employed in other
 # parts of the simplification process being their superset.
@@ -4,18 +4,15 @@ def pow2(n):
 def mask(n):
     return (1 << n) - 1
 
-POPCOUNT_TABLE16 = [0] * 2**16
-for i in range(len(POPCOUNT_TABLE16)):
-    POPCOUNT_TABLE16[i] = (i & 1) + POPCOUNT_TABLE16[i >> 1]
-
-def popcnt(n):
-    return (POPCOUNT_TABLE16[ n        & 0xffff] +
-            POPCOUNT_TABLE16[(n >> 16) & 0xffff])
+# int.bit_count is there since Python 3.10
+if hasattr(int, 'bit_count'):
+    popcnt = int.bit_count
+else:
+    def popcnt(n):
+        return bin(n).count('1')
 
 def hamming_distance(lhs, rhs):
-    n = lhs ^ rhs
-    return (POPCOUNT_TABLE16[ n        & 0xffff] +
-            POPCOUNT_TABLE16[(n >> 16) & 0xffff])
+    return popcnt(lhs ^ rhs)
 
 def is_pow2(n):
     return ((n & (n-1)) == 0)
@@ -3,6 +3,8 @@ import re
 import time
 import random
 import argparse
+import contextlib
+import concurrent.futures
 
 from boolsim import *
 
@@ -12,20 +14,25 @@ def verbose_callback(msg):
 def full(args):
     #print('\nOriginal: ' + str(args.expr))
     #print(parse_expression(args.expr).complexity)
-    simplifier = FullSimplifier(
-        full_simplification_ruleset,
-        parse_expression(args.expr),
-        args.c,
-        args.m,
-        args.q,
-        args.p,
-        verbose_callback if args.v else None
-        )
-    if args.s == -1:
-        simplifier.step_until_done()
-    else:
-        for i in range(args.s):
-            simplifier.step()
+    with contextlib.ExitStack() as stack:
+        executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(args.j)) if args.j > 1 else None
+        cache = stack.enter_context(SimplificationCache(args.cache)) if args.cache else None
+        simplifier = FullSimplifier(
+            full_simplification_ruleset,
+            parse_expression(args.expr),
+            args.c,
+            args.m,
+            args.q,
+            args.p,
+            verbose_callback if args.v else None,
+            cache=cache,
+            executor=executor
+            )
+        if args.s == -1:
+            simplifier.step_until_done()
+        else:
+            for i in range(args.s):
+                simplifier.step()
 
     print(simplifier.best_expr())
     #print(simplifier.best_expr().complexity)
@@ -60,6 +67,8 @@ def main():
     parser_full.add_argument('-m', type=int, default=10, help='expressions with complexity less than this won\'t be pruned early')
     parser_full.add_argument('-q', type=int, default=8, help='max number of expressions that qualify to the next step')
     parser_full.add_argument('-s', type=int, default=-1, help='max number of steps to execute')
+    parser_full.add_argument('-j', type=int, default=1, help='number of processes to permute expressions in')
+    parser_full.add_argument('--cache', type=str, default=None, help='file to keep simplified expressions in, reused in later runs')
     parser_full.add_argument('-v', action='store_true', help='adds trace of the simplification process to the output')
     parser_full.add_argument('expr', type=str, help='expression to simplify')
     parser_full.set_defaults(func=full)
@@ -4,6 +4,9 @@ import time
 import random
 import itertools
 import fileinput
+import os
+import tempfile
+import concurrent.futures
 
 from boolsim import *
 
@@ -44,6 +47,154 @@ def test(expr_str, expected_expr_str):
 
     print('------------------------------------------------------------')
 
+def test_cache(expr_str):
+    expr = parse_expression(expr_str)
+
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, 'cache')
+        with SimplificationCache(path) as cache:
+            min_expr = FullSimplifier(full_simplification_ruleset, expr, cache=cache).step_until_done().best_expr()
+
+        # reopened, so the result comes from the file
+        with SimplificationCache(path) as cache:
+            cached_expr = cache.get(expr)
+            cached_simplifier = FullSimplifier(full_simplification_ruleset, expr, cache=cache)
+
+    print('[Cached; Complexity: {0}]: {1}'.format(min_expr.complexity, cached_expr))
+
+    if cached_expr is None or not are_equal_by_evaluation(expr, cached_expr):
+        print('Invalid cached simplification!')
+    elif cached_expr.complexity != min_expr.complexity:
+        print('Invalid cached simplification! Expected [Complexity: {0}; Expr: {1}]'.format(min_expr.complexity, min_expr))
+    elif not cached_simplifier.is_completed or cached_simplifier.best_expr() is not cached_expr:
+        print('Invalid cached simplification! Not used by the simplifier.')
+
+    print('------------------------------------------------------------')
+
+class CountingExecutor(concurrent.futures.ProcessPoolExecutor):
+    # to tell whether the simplifier handed any work to the workers
+    num_maps = 0
+
+    def map(self, *args, **kwargs):
+        self.num_maps += 1
+        return super().map(*args, **kwargs)
+
+def test_executor(expr_str):
+    expr = parse_expression(expr_str)
+
+    min_expr = FullSimplifier(full_simplification_ruleset, expr).step_until_done().best_expr()
+    with CountingExecutor(2) as executor:
+        parallel_min_expr = FullSimplifier(full_simplification_ruleset, expr, executor=executor).step_until_done().best_expr()
+
+    print('[Parallel; Complexity: {0}; Maps: {1}]: {2}'.format(parallel_min_expr.complexity, executor.num_maps, parallel_min_expr))
+
+    if executor.num_maps == 0:
+        print('Invalid parallel simplification test! The executor was not used.')
+    elif parallel_min_expr is not min_expr:
+        print('Invalid parallel simplification! Expected [Complexity: {0}; Expr: {1}]'.format(min_expr.complexity, min_expr))
+
+    print('------------------------------------------------------------')
+
+def test_fold(cls, operand_strs, expected_expr_str):
+    operands = [parse_expression(e) for e in operand_strs]
+    expected_expr = parse_expression(expected_expr_str)
+    folded = cls.of(operands)
+
+    print('[{0}.of; Complexity: {1}]: {2} -> {3}'.format(cls.__name__, folded.complexity, ', '.join(str(e) for e in operands), folded))
+
+    if not are_equal_by_evaluation(folded, expected_expr):
+        print('Invalid fold!')
+    elif folded.complexity != expected_expr.complexity:
+        print('Invalid fold! Expected [Complexity: {0}; Expr: {1}]'.format(expected_expr.complexity, expected_expr))
+
+    print('------------------------------------------------------------')
+
+def test_absorption(expr_str, expected_expr_str):
+    expr = parse_expression(expr_str)
+    expected_expr = parse_expression(expected_expr_str)
+    # without lookup tables, so only the children are looked at
+    simplified = expr.try_simplify_by_children_evaluation(None)
+
+    print('[Absorbed]: {0} -> {1}'.format(expr, simplified))
+
+    if simplified is not expected_expr:
+        print('Invalid absorption! Expected {0}'.format(expected_expr))
+
+    print('------------------------------------------------------------')
+
+def truth_table_relation(lhs, rhs):
+    # (equal, opposite) computed from truth tables, to check the decision
+    # diagrams against
+    if lhs.symbols.isdisjoint(rhs.symbols):
+        # only the same or opposite constants are related,
+        # each checked on its own table
+        values = []
+        for e in (lhs, rhs):
+            ids_to_symbols = gather_symbols_from_expr(e)
+            tt = evaluate_truth_table(e, ids_to_symbols)
+            values.append({0 : False, mask(pow2(len(ids_to_symbols))) : True}.get(tt))
+        if None in values:
+            return False, False
+        return values[0] == values[1], values[0] != values[1]
+
+    ids_to_symbols = sorted(lhs.symbols | rhs.symbols)
+    lhs_tt, rhs_tt = evaluate_truth_tables([lhs, rhs], ids_to_symbols)
+    return lhs_tt == rhs_tt, lhs_tt == rhs_tt ^ mask(pow2(len(ids_to_symbols)))
+
+def test_bdd(lhs_str, rhs_str):
+    lhs = parse_expression(lhs_str)
+    rhs = parse_expression(rhs_str)
+    num_symbols = len(lhs.symbols | rhs.symbols)
+
+    expected = truth_table_relation(lhs, rhs)
+    actual = (are_equal_by_evaluation(lhs, rhs), are_opposite_by_evaluation(lhs, rhs))
+
+    print('[BDD; Symbols: {0}; Equal: {1}; Opposite: {2}]: {3} ? {4}'.format(num_symbols, actual[0], actual[1], lhs, rhs))
+
+    if num_symbols < BDD_MIN_SYMBOLS:
+        print('Invalid decision diagram test! Too few symbols.')
+    elif actual != expected:
+        print('Invalid decision diagram comparison! Expected [Equal: {0}; Opposite: {1}]'.format(*expected))
+
+    print('------------------------------------------------------------')
+
+def test_match_all(expr_str):
+    expr = parse_expression(expr_str)
+    rules = full_simplification_ruleset.permuting_rules + full_simplification_ruleset.reducing_rules
+
+    num_exprs = 0
+    mismatched_rules = []
+    for to_match, to_apply in rules:
+        applied = expr.apply_pattern_recursively_to_all(to_match, to_apply)
+        expected = {expr.apply_pattern_after_path(to_match, to_apply, path) for path in expr.get_paths_to_all_matches(to_match)}
+        num_exprs += len(applied)
+        if applied != expected:
+            mismatched_rules += [(to_match, to_apply)]
+
+    print('[Match all; Rules: {0}; Expressions: {1}]: {2}'.format(len(rules), num_exprs, expr))
+
+    for to_match, to_apply in mismatched_rules:
+        print('Invalid match of all! Rule: {0} -> {1}'.format(to_match, to_apply))
+
+    print('------------------------------------------------------------')
+
+def test_match_program(expr_str, pattern_str, expected_captures):
+    expr = parse_expression(expr_str)
+    pattern = parse_expression(pattern_str)
+
+    def as_sorted(all_captures):
+        return sorted(sorted((name, str(e)) for name, e in captures.items()) for captures in all_captures)
+
+    actual = as_sorted(compile_pattern(pattern).matches(expr))
+    expected = as_sorted({name : parse_expression(e) for name, e in captures.items()} for captures in expected_captures)
+
+    print('[Match program; Matches: {0}]: {1} ~ {2}'.format(len(actual), expr, pattern))
+
+    if actual != expected:
+        print('Invalid match program! Expected {0}, got {1}'.format(expected, actual))
+
+    print('------------------------------------------------------------')
+
 def main():
     start = time.time()
 
@@ -134,6 +285,48 @@ def main():
     test('(!a&((b|c)&d))|(!((c|b)&d)&a)', 'a^(b|c&d)')
     test('A&B|C&D|E&F|G&H', 'A&B|C&D|E&F|G&H')
     test('A1A1&B00B2', 'A1A1&B00B2')
+    xs = ['x{0}'.format(i) for i in range(20)]
+    ys = ['y{0}'.format(i) for i in range(20)]
+    all_xs = '(' + '&'.join(xs) + ')'
+    any_ys = '(' + '|'.join(ys) + ')'
+    test_bdd('!' + all_xs, '|'.join('!' + x for x in xs))
+    test_bdd('^'.join(xs), '!((' + '^'.join(xs[:-1]) + ')<=>' + xs[-1] + ')')
+    test_bdd(all_xs + '|y', 'y') # differs only for one of the inputs
+    test_bdd(all_xs + '|y', '!y&!' + all_xs)
+    test_bdd(all_xs + '|y', '!y&!' + all_xs + '|(' + '&'.join(xs[1:]) + '&!x0)')
+    test_bdd(all_xs + '&!x0', any_ys + '&!' + any_ys) # no common symbols, both false
+    test_bdd(all_xs + '&!x0', any_ys + '|!y0') # no common symbols, false and true
+    test_bdd(all_xs, any_ys) # no common symbols, neither is constant
+
+    test_fold(Conjunction, [], '1')
+    test_fold(Disjunction, [], '0')
+    test_fold(Conjunction, ['a', '!a'], '0')
+    test_fold(Disjunction, ['a', '!a'], '1')
+    test_fold(Conjunction, ['b', 'c&!a', '!d&(b&c)'], '!a&b&c&!d') # duplicates and nested operands
+    test_fold(Disjunction, ['a', 'b|(a|c)', 'b&c'], 'a|b|c|(b&c)') # only the same operator is flattened
+
+    test_absorption('a&(a|b)', 'a')
+    test_absorption('(b|a)&a', 'a')
+    test_absorption('a|(a&b)', 'a')
+    test_absorption('(a&b)|a', 'a')
+    test_absorption('a|(!a&b)', 'a|(!a&b)') # not absorbed, needs evaluation
+
+    test_match_program('!a&a', 'x&!x', [{'x' : 'a'}]) # only the swapped order matches
+    test_match_program('a&b', 'x&y', [{'x' : 'a', 'y' : 'b'}, {'x' : 'b', 'y' : 'a'}])
+    test_match_program('(a|b)&(a|c)', '(x|y)&(x|z)', [{'x' : 'a', 'y' : 'b', 'z' : 'c'}, {'x' : 'a', 'y' : 'c', 'z' : 'b'}]) # captures undone on backtracking
+    test_match_program('a|a', 'x|x', [{'x' : 'a'}, {'x' : 'a'}])
+    test_match_program('a|b', 'x|x', [])
+    test_match_program('(a&!b)|!(!a|b)', 'x|x', [{'x' : 'a&!b'}, {'x' : '!(!a|b)'}]) # equal by evaluation, the first capture is kept
+    test_match_program('(a|a)&(!a|a)', '(y|x)&x', [{'x' : 'a', 'y' : '!a'}]) # x is captured inside the disjunction first
+
+    test_match_all('(X&Z)|(Z&(!X|(X&Y)))')
+    test_match_all('(a|a)&(a|!a)') # repeated symbols capture equal subtrees
+    test_match_all('!((A^B=>C|(A&B))&(C|(A&B)=>A^B))')
+
+    test_executor('(!a&((b|c)&d))|(!((c|b)&d)&a)')
+    test_cache('(!a&((b|c)&d))|(!((c|b)&d)&a)')
+    test_cache('A&B|C&D|E&F|G&H') # minimal already, so cached as itself
+
     test('((((c|b|a)&(c|!a)&!b)^(!d&a))&(d^e)&!(!(d^e)&!(((c|b|a)&(c|!a)&!b&!(!d&a))|(!((c|b|a)&(c|!a)&!b)&!d&a))))|(!(d^e)&!(((c|b|a)&(c|!a)&!b&!(!d&a))|(!((c|b|a)&(c|!a)&!b)&!d&a)))', 'e<=>a|d<=>(c=>b)') # hard but finds it reasonably well
     #test('(!B&D&!E) | (!A&!D&!E) | (!B&C&!E) | (!A&!C&!E) | (B&!C&!D&!E) | (B&!C&D&E) | (A&C&D&!E) | (A&C&!D&E) | (!A&C&D&E) | (!A&!B&!C&!D)', '(E&C=>A^D)&((E=>C)|(D<=>B))&((A=>D)|B|C)&((B=>(C=>E))|(A<=>D))&(B=>(A&D=>E|C))') # very hard and unproven
     # '''
@@ -195,8 +388,7 @@ def bool_array_to_int(arr):
     return i
 
 def evall(expr, ids_to_symbols):
-    dim = len(ids_to_symbols)
-    return [expr.evaluate(symbol_dict_from_index(ids_to_symbols, BoolVector(dim, i))) for i in range(pow2(dim))]
+    return evaluate_all(expr, ids_to_symbols)
 
 
 